@@ -5,5 +5,6 @@ __email__ = 'phillip.piper@gmail.com'
 __version__ = '0.1.0'
 
 # Make some symbols publically visible outside the module 
-__all__ = ['AsyncParser']
+__all__ = ['AsyncParser', 'Message']
 
+from asyncparser import AsyncParser, Message
@@ -1,48 +1,76 @@
 # -*- coding: utf-8 -*-
 
+import cPickle
 import logging
+import os
 import Queue
 import time
 import threading
-from hipchatparser import HipChatParser, NullUrlFetcher
+import zlib
+from hipchatparser import HipChatParser, NullUrlFetcher, UrlFetcher
+
+
+class Message:
+    """
+    Simple DTO-style object representing a message in a chat system
+    """
+
+    def __init__(self, message_id, conversation_id, user_id, text):
+        self.message_id = message_id
+        self.conversation_id = conversation_id
+        self.user_id = user_id
+        self.text = text
+        self.details = None
+
+    def __str__(self):
+        return "'%s' (user: %s, cid: %s, id: %s)" % (self.text, self.user_id, self.conversation_id, self.message_id)
 
 
 class ParserWorkerThread(threading.Thread):
     """
     Instances of this class examine messages and fill in the title for any urls in the message
+
+    A worker simply blocks on its queue until there is something to do. It stops when it takes
+    the STOP sentinel from the queue, so an idle worker never has to wake up to check if it should stop.
     """
 
-    def __init__(self, thread_id, in_q, out_q, timeout=1):
+    # Putting this on the queue stops one of the workers reading from that queue
+    STOP = object()
+
+    def __init__(self, thread_id, in_q, out_q, parser):
         threading.Thread.__init__(self)
         self.daemon = True
         self.name = "Worker %d" % thread_id
         self._logger = logging.getLogger(self.name)
         self._in_q = in_q
         self._out_q = out_q
-        self._timeout = timeout
-        self._stopped = threading.Event()
 
-        # Use a parser to do this lookup
-        self._parser = HipChatParser()
+        # Use a parser to do this lookup. It is usually shared with the other workers
+        self._parser = parser
 
     def run(self):
         self._logger.debug('Worker starting')
-        while not self._stopped.is_set():
+        while True:
+            item = self._in_q.get()
             try:
-                item = self._in_q.get(True, self._timeout)
+                if item is ParserWorkerThread.STOP:
+                    break
                 self._worker_process(item)
+            except Exception:
+                # A bad message must not kill the worker, or its STOP sentinel would be left for a later worker
+                self._logger.exception('Failed to process: %s', item)
+            finally:
                 self._in_q.task_done()
-            except Queue.Empty:
-                # After sufficient time with no items being on the queue, we should probably reclaim this thread
-                pass
         self._logger.debug('Worker stopping')
 
-    def join(self, timeout=None):
+    def stop(self):
         """
-        Stop all processing on this thread
+        Ask a worker to stop once the messages already on the queue have been taken, without waiting for it.
+
+        Workers that share a queue also share its STOP sentinels, so it may be a different worker that stops.
+        Call this once for each worker on the queue to stop them all.
         """
-        self._stopped.set()
-        super(ParserWorkerThread, self).join(timeout)
+        self._in_q.put(ParserWorkerThread.STOP)
 
     def _worker_process(self, msg):
         """
@@ -63,44 +91,182 @@ class ParserWorkerThread(threading.Thread):
         """
         Fill in whatever details we can about the message.
         """
-        for d in msg.details[HipChatParser.DETAIL_LINKS]:
-            d[HipChatParser.DETAIL_TITLE] = self._parser.fetch_title(d[HipChatParser.DETAIL_URL])
+        links = msg.details[HipChatParser.DETAIL_LINKS]
+        titles = self._parser.fetch_titles([d[HipChatParser.DETAIL_URL] for d in links])
+        for (d, title) in zip(links, titles):
+            d[HipChatParser.DETAIL_TITLE] = title
+
+
+class BatchingQueue:
+    """
+    Instances of this class group the items put on them into batches (lists), and put those batches on an output queue.
+
+    A batch is sent once it has batch_size items, or batch_interval seconds after its first item arrived,
+    whichever comes first. An item that is put again while it is still in the pending batch isn't added
+    a second time -- the batch already holds the item, so it will go out in its latest state.
+    :attr:`merged` counts how many items were merged like this.
+
+    The flushing thread only wakes up when there is a pending batch to time out. Once the queue is closed,
+    each item put on it goes straight to the output queue, in a batch of its own.
+    """
+
+    def __init__(self, out_q, batch_size, batch_interval):
+        """
+        :param out_q: The queue that the batches are put on
+        :param batch_size: The most items in a batch
+        :param batch_interval: The most seconds an item waits before its batch is sent
+        """
+        self._out_q = out_q
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._condition = threading.Condition()
+        self._batch = []
+        self._pending = set()
+        self._deadline = None
+        self._closed = False
+        self.merged = 0
+
+        self._thread = threading.Thread(target=self._run, name='Batcher')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, item):
+        """
+        Add the given item to the pending batch
+        """
+        with self._condition:
+            if self._closed:
+                # There is no flushing thread to send a pending batch any more
+                self._out_q.put([item])
+                return
+            if id(item) in self._pending:
+                self.merged += 1
+                return
+            self._batch.append(item)
+            self._pending.add(id(item))
+            if len(self._batch) >= self._batch_size:
+                self._flush()
+            elif len(self._batch) == 1:
+                self._deadline = time.time() + self._batch_interval
+                self._condition.notify()
+
+    def close(self):
+        """
+        Send the pending batch, and stop the flushing thread
+        """
+        with self._condition:
+            self._flush()
+            self._closed = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _run(self):
+        with self._condition:
+            while not self._closed:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.time()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                else:
+                    self._flush()
+
+    def _flush(self):
+        """
+        Send the pending batch, if there is one. The condition must be held.
+        """
+        if self._batch:
+            self._out_q.put(self._batch)
+        self._batch = []
+        self._pending = set()
+        self._deadline = None
 
 
 class AsyncParser:
     """
     Create a message parser which decodes details about the provided messages and dispatches
     the resulting augmented messages to an output queue.
+
+    If a checkpoint path is given, any messages whose titles have not been looked up when the parser
+    is stopped are saved to that file, and are looked up once the parser is next started.
+    The file is only replaced (or removed) when the parser is next stopped, so if the process dies before then,
+    the checkpointed messages are resumed again by the start after that. Checkpointed messages must be picklable.
+
+    If a recorder (see :class:`traffic.TrafficRecorder`) is given, every parsed message and every
+    url fetch is recorded, so that the traffic can later be replayed offline.
+
+    If a batch size is given, then while the parser is started, the output queue receives lists of messages
+    rather than single messages (see :class:`BatchingQueue`). A title update for a message that is still
+    waiting in a batch is merged into that batch, so the message and its update go out as one item.
+
+    If an emoticon vocabulary (see :class:`hipchatparser.EmoticonVocabulary`) is given, only the emoticons
+    named in it are reported. If a user directory (see :class:`hipchatparser.UserDirectory`) is given,
+    mentions are resolved to user ids.
     """
 
     _logger = logging.getLogger('AsyncParser')
 
-    def __init__(self, number_workers=5):
+    def __init__(self, number_workers=5, checkpoint_path=None, url_fetcher=None, recorder=None,
+                 batch_size=None, batch_interval=0.1, emoticon_vocabulary=None, user_directory=None):
         self._worker_q = Queue.Queue()
         self.out_q = Queue.Queue()
         self._number_workers = number_workers
+        self._batch_size = batch_size
+        self._batch_interval = batch_interval
+        self._out = self.out_q
+        self._checkpoint_path = checkpoint_path
+        self._recorder = recorder
+        if recorder is not None:
+            url_fetcher = recorder.wrap(url_fetcher if url_fetcher is not None else UrlFetcher())
         self._threads = []
 
+        # HipChatParser is thread safe, so all the workers share this one parser (and its url fetcher)
+        self._slowParser = HipChatParser(url_fetcher)
+
         # Make a "fast" parser, by simply install a url fetcher that return an empty string.
         # (sometimes you just have to love the power of dependency injection :)
-        self._fastParser = HipChatParser(NullUrlFetcher())
+        self._fastParser = HipChatParser(NullUrlFetcher(), emoticon_vocabulary, user_directory)
 
     def start(self):
         """
         Start pulling messages from the queue and dispatching them to the out queue
         """
         self._logger.debug('Starting...')
+        if self._batch_size:
+            self._out = BatchingQueue(self.out_q, self._batch_size, self._batch_interval)
+        # Messages parsed while stopped are kept, but any STOP sentinels left by the last stop() are not
+        for msg in self._take_waiting_messages():
+            self._worker_q.put(msg)
         # In a real app, we would manage these threads more intelligently
         self._threads = [self._create_worker(i) for i in range(self._number_workers)]
+        self._resume_checkpoint()
         self._logger.info('Started')
 
-    def stop(self):
+    def stop(self, drain_timeout=None):
         """
-        Shutdown this processor in an orderly fashion
+        Shutdown this processor in an orderly fashion.
+
+        Messages that the workers are currently processing are always finished. Messages that
+        are still waiting to be processed are checkpointed (if there is a checkpoint path).
+        All the workers are stopped at the same time, so this takes no longer than the slowest worker.
+
+        :param drain_timeout: If not None, first give the workers up to this many seconds to finish
+            all the waiting messages
         """
         self._logger.debug('Stopping...')
+        if drain_timeout is not None and not self._drain(time.time() + drain_timeout):
+            self._logger.info('Drain timed out after %s seconds', drain_timeout)
+        waiting = self._take_waiting_messages()
+        for t in self._threads:
+            t.stop()
         for t in self._threads:
             t.join()
+        self._threads = []
+        self._save_checkpoint(waiting)
+        if self._out is not self.out_q:
+            (batcher, self._out) = (self._out, self.out_q)
+            batcher.close()
         self._logger.info('Stopped')
 
     def parse(self, msg):
@@ -108,45 +274,95 @@ class AsyncParser:
         Parses the given message and send the result to the output queue
         """
         self._logger.debug('Parsing: %s', msg)
+        if self._recorder is not None:
+            self._recorder.record_message(msg.text)
 
         # Quickly decode the details that we can do without delay
         msg.details = self._fastParser.parse_to_dict(msg.text)
         msg.details_as_json = self._fastParser.dict_to_json(msg.details)
 
         # Pumps out the message. "slow" details are not yet filled in
-        self.out_q.put(msg)
+        self._out.put(msg)
 
         # If the message had links, send it to the workers, which will
         # produced an updated message once the details are filled in
         if HipChatParser.DETAIL_LINKS in msg.details:
             self._worker_q.put(msg)
 
+    def _drain(self, deadline):
+        """
+        Wait until the workers have processed all waiting messages, or until the deadline passes
+
+        :return: True if all the messages were processed
+        """
+        q = self._worker_q
+        with q.all_tasks_done:
+            while q.unfinished_tasks:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                q.all_tasks_done.wait(remaining)
+        return True
+
+    def _take_waiting_messages(self):
+        """
+        Remove and return all the messages that are waiting to be processed by the workers.
+        Any STOP sentinels on the queue are removed too, but are not returned.
+        """
+        messages = []
+        while True:
+            try:
+                item = self._worker_q.get_nowait()
+                self._worker_q.task_done()
+            except Queue.Empty:
+                return messages
+            if item is not ParserWorkerThread.STOP:
+                messages.append(item)
+
+    def _save_checkpoint(self, messages):
+        """
+        Save the given unprocessed messages to the checkpoint file, so they can be resumed by the next start().
+        This replaces any checkpoint that was resumed by the last start().
+        """
+        if not messages:
+            if self._checkpoint_path is not None and os.path.exists(self._checkpoint_path):
+                os.remove(self._checkpoint_path)
+            return
+        if self._checkpoint_path is None:
+            self._logger.warning('Discarding %d unprocessed messages', len(messages))
+            return
+
+        # Write to a temporary file first, so a crash can't leave a half written checkpoint
+        temp_path = self._checkpoint_path + '.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(zlib.compress(cPickle.dumps(messages, cPickle.HIGHEST_PROTOCOL)))
+        os.rename(temp_path, self._checkpoint_path)
+        self._logger.info('Checkpointed %d unprocessed messages', len(messages))
+
+    def _resume_checkpoint(self):
+        """
+        Send any messages saved by the last stop() to the workers.
+        The checkpoint file is left in place until the next stop() has dealt with all of its messages.
+        """
+        if self._checkpoint_path is None or not os.path.exists(self._checkpoint_path):
+            return
+        with open(self._checkpoint_path, 'rb') as f:
+            messages = cPickle.loads(zlib.decompress(f.read()))
+        for msg in messages:
+            self._worker_q.put(msg)
+        self._logger.info('Resumed %d checkpointed messages', len(messages))
+
     def _create_worker(self, worker_id):
         """
         Create and start a worker that will collect more costly message details
         """
-        w = ParserWorkerThread(worker_id, self._worker_q, self.out_q)
+        w = ParserWorkerThread(worker_id, self._worker_q, self._out, self._slowParser)
         w.start()
         return w
 
 
 def main():
 
-    class Message:
-        """
-        Simple DTO-style object representing a message in a chat system
-        """
-
-        def __init__(self, message_id, conversation_id, user_id, text):
-            self.message_id = message_id
-            self.conversation_id = conversation_id
-            self.user_id = user_id
-            self.text = text
-            self.details = None
-
-        def __str__(self):
-            return "'%s' (user: %s, cid: %s, id: %s)" % (self.text, self.user_id, self.conversation_id, self.message_id)
-
     class Consumer(threading.Thread):
         """
         Simple consumer of a queue
@@ -154,31 +370,31 @@ def main():
 
         _logger = logging.getLogger('Consumer')
 
+        STOP = object()
+
         def __init__(self, q):
             threading.Thread.__init__(self)
             self._q = q
             self.daemon = True
-            self._stopped = threading.Event()
 
         def run(self):
             self._logger.debug('Starting...')
 
-            while not self._stopped.is_set():
-                try:
-                    msg = self._q.get(True, 1)
-                    self._logger.info('%s', msg)
-                    self._logger.info('JSON: %s', msg.details_as_json)
-                    self._q.task_done()
-                except Queue.Empty:
-                    pass
+            while True:
+                msg = self._q.get()
+                self._q.task_done()
+                if msg is Consumer.STOP:
+                    break
+                self._logger.info('%s', msg)
+                self._logger.info('JSON: %s', msg.details_as_json)
 
             self._logger.debug('Stopped')
 
         def join(self, timeout=None):
             """
-            Stop all processing on this thread
+            Stop all processing on this thread, once everything already on the queue has been consumed
             """
-            self._stopped.set()
+            self._q.put(Consumer.STOP)
             super(Consumer, self).join(timeout)
 
     init_logging()
@@ -203,7 +419,7 @@ def main():
     parser.start()
     for x in messages:
         parser.parse(x)
-    parser.stop()
+    parser.stop(drain_timeout=30)
     consumer.join()
 
 
@@ -0,0 +1,388 @@
+# -*- coding: utf-8 -*-
+
+"""
+Capture and replay of the traffic seen by an AsyncParser.
+
+A TrafficRecorder given to an AsyncParser writes an anonymized copy of every message it parses,
+and the outcome of every url it fetches, to a capture file. A LoadGenerator later replays that capture
+against a parser, at any speed, with the urls pointing at a local FakeHttpServer that answers each one
+the way it was answered when it was recorded -- including how long it took to answer. The parser should
+fetch with a ReplayUrlFetcher, so that it still tells the recorded hosts apart.
+
+The capture file has one JSON object per line. Each is either a message or a fetch::
+
+    {"message": "xxxx @u1f0c63d2 (coffee) http://h5e8a1b9c.invalid/0b7c3e9a41d2", "t": 1.2503}
+    {"bytes": 16384, "latency": 0.1532, "status": 200, "t": 1.4121, "title_size": 42, "url": "http://..."}
+
+where "t" is the number of seconds since recording started.
+"""
+
+import argparse
+import BaseHTTPServer
+import hashlib
+import json
+import os
+import random
+import re
+import SocketServer
+import threading
+import time
+import urlparse
+from asyncparser import AsyncParser, Message
+from hipchatparser import HipChatParser, UrlFetcher
+
+
+class Anonymizer:
+    """
+    Instances of this class remove anything identifying from messages, while keeping their features.
+
+    Mentions and urls are replaced by salted hashes, so the same user or url is always anonymized
+    the same way within a capture. Emoticons are only kept if they are in the given vocabulary. Anything
+    else in parenthesis that looks like an emoticon, such as "(password1)", is replaced by a hash too.
+    Every other run of text that isn't white space or ASCII punctuation -- in any language -- is replaced
+    by x's, so the message keeps its length and shape.
+    """
+
+    # Groups: url, mention, emoticon name, and any other run of text that isn't space or ASCII punctuation
+    _re_token = re.compile('(%s)|(@\w+)|\(([0-9a-zA-Z]{1,15})\)|([^\s!-/:-@\[-`{-~]+)'
+                           % HipChatParser._re_url.pattern, re.UNICODE)
+
+    def __init__(self, salt=None, emoticon_vocabulary=None):
+        """
+        :param salt: The salt used for the hashes. Defaults to a random salt
+        :param emoticon_vocabulary: The :class:`EmoticonVocabulary` of emoticons that can be kept as they are.
+            If None, every emoticon is hashed
+        """
+        self._salt = salt if salt is not None else os.urandom(8).encode('hex')
+        self._emoticon_vocabulary = emoticon_vocabulary
+
+    def text(self, message):
+        """
+        Return an anonymized version of the given message
+        """
+        return self._re_token.sub(self._replace, message)
+
+    def url(self, url):
+        """
+        Return an anonymized version of the given url. Urls with the same canonical form are anonymized
+        to the same url, and urls on the same host are given the same anonymized host.
+        """
+        canonical = HipChatParser.canonicalize_url(url)
+        try:
+            host = urlparse.urlsplit(canonical).netloc
+        except ValueError:
+            # Such as an unbalanced '[' in the host. Use whatever is between the '//' and the next '/'
+            host = canonical.partition('//')[2].partition('/')[0]
+        return 'http://h%s.invalid/%s' % (self._hash(host)[:8], self._hash(canonical)[:12])
+
+    def _replace(self, match):
+        (url, mention, emoticon, word) = match.groups()
+        if url:
+            return self.url(url)
+        if mention:
+            return '@u' + self._hash(mention.lower())[:8]
+        if emoticon:
+            if self._emoticon_vocabulary is not None and emoticon in self._emoticon_vocabulary:
+                return '(%s)' % emoticon
+            return '(e%s)' % self._hash(emoticon)[:8]
+        return 'x' * len(word)
+
+    def _hash(self, s):
+        if isinstance(s, unicode):
+            s = s.encode('utf-8')
+        return hashlib.sha1(self._salt + s).hexdigest()
+
+
+class TrafficRecorder:
+    """
+    Instances of this class write an anonymized record of messages and url fetches to a capture file.
+
+    Give one to an :class:`AsyncParser` to record its traffic. Recording is thread safe.
+    """
+
+    def __init__(self, path, salt=None, emoticon_vocabulary=None):
+        """
+        Create a recorder that writes to the given capture file
+
+        :param path: The path of the capture file. It will be overwritten
+        :param salt: The salt used when anonymizing. Defaults to a random salt
+        :param emoticon_vocabulary: The known emoticons, which are recorded as they are. See :class:`Anonymizer`
+        """
+        self._anonymizer = Anonymizer(salt, emoticon_vocabulary)
+        self._file = open(path, 'w')
+        self._lock = threading.Lock()
+        self._start = time.time()
+
+    def record_message(self, text):
+        """
+        Record that the given message was parsed
+        """
+        self._write({'message': self._anonymizer.text(text)})
+
+    def record_fetch(self, url, latency, status, size, title_size):
+        """
+        Record the outcome of fetching the given url
+
+        :param url: The url that was fetched
+        :param latency: How many seconds the fetch took
+        :param status: The HTTP status of the response, or 0 if there was no response
+        :param size: The number of bytes fetched
+        :param title_size: The length of the page's title, or 0 if it didn't have one
+        """
+        self._write({
+            'url': self._anonymizer.url(url),
+            'latency': round(latency, 4),
+            'status': status,
+            'bytes': size,
+            'title_size': title_size,
+        })
+
+    def wrap(self, url_fetcher):
+        """
+        Return a url fetcher that records every fetch made through the given url fetcher
+        """
+        return RecordingUrlFetcher(url_fetcher, self)
+
+    def close(self):
+        """
+        Finish recording
+        """
+        with self._lock:
+            self._file.close()
+
+    def _write(self, record):
+        with self._lock:
+            record['t'] = round(time.time() - self._start, 4)
+            self._file.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+class RecordingUrlFetcher:
+    """
+    This url fetcher records the outcome of every fetch made by another url fetcher
+    """
+
+    def __init__(self, url_fetcher, recorder):
+        self._url_fetcher = url_fetcher
+        self._recorder = recorder
+
+    def get(self, url):
+        return self.fetch(url)[1]
+
+    def fetch(self, url):
+        start = time.time()
+        if hasattr(self._url_fetcher, 'fetch'):
+            (status, html) = self._url_fetcher.fetch(url)
+        else:
+            html = self._url_fetcher.get(url)
+            status = 200 if html else 0
+        latency = time.time() - start
+
+        match = HipChatParser._re_title.search(html)
+        self._recorder.record_fetch(url, latency, status, len(html), len(match.group(1)) if match else 0)
+        return status, html
+
+
+class TrafficCapture:
+    """
+    The contents of a capture file
+    """
+
+    # Used for urls when nothing at all was fetched during the capture
+    _DEFAULT_OUTCOME = {'latency': 0.0, 'status': 200, 'bytes': 0, 'title_size': 0}
+
+    def __init__(self, messages, fetches):
+        """
+        :param messages: A list of (seconds since the first message, anonymized text) pairs
+        :param fetches: A list of fetch records
+        """
+        self.messages = messages
+        self.fetches = fetches
+        self._outcomes_by_url = dict()
+        for x in fetches:
+            self._outcomes_by_url.setdefault(x['url'], []).append(x)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Read the capture file at the given path
+        """
+        messages = []
+        fetches = []
+        with open(path) as f:
+            for line in f:
+                record = json.loads(line)
+                if 'message' in record:
+                    messages.append((record['t'], record['message']))
+                else:
+                    fetches.append(record)
+        if messages:
+            first = messages[0][0]
+            messages = [(t - first, text) for (t, text) in messages]
+        return cls(messages, fetches)
+
+    def outcome(self, url, rnd=random):
+        """
+        Return a recorded outcome of fetching the given url.
+
+        If the url was fetched more than once, one of its outcomes is chosen at random. If it was never
+        fetched, an outcome is chosen at random from all fetches, so the overall latency distribution is kept.
+        """
+        outcomes = self._outcomes_by_url.get(url) or self.fetches
+        return rnd.choice(outcomes) if outcomes else TrafficCapture._DEFAULT_OUTCOME
+
+
+class _FakeHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer each request the way its url was answered when it was recorded
+    """
+
+    def do_GET(self):
+        outcome = self.server.outcome('http://' + self.path.lstrip('/'))
+        time.sleep(outcome['latency'] * self.server.latency_scale)
+
+        # A fetch that got no response at all is the closest thing to a gateway timeout
+        status = outcome['status'] or 504
+        body = self._page(outcome) if 200 <= status < 300 else ''
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+    @staticmethod
+    def _page(outcome):
+        """
+        Make a page of the recorded size, whose title is of the recorded size
+        """
+        title_size = outcome['title_size']
+        page = '<html><head><title>%s</title></head><body>' % ('x' * title_size) if title_size else '<html><body>'
+        return page + ' ' * max(0, outcome['bytes'] - len(page))
+
+
+class FakeHttpServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local HTTP server that answers requests for the urls in a capture just as they were answered when recorded
+    """
+
+    daemon_threads = True
+
+    _re_anonymized_url = re.compile('http://(h[0-9a-f]+\.invalid/)')
+
+    def __init__(self, capture, latency_scale=1.0, seed=None):
+        """
+        Create a server on a free local port
+
+        :param capture: The :class:`TrafficCapture` whose fetches should be reproduced
+        :param latency_scale: Every recorded latency is multiplied by this
+        :param seed: Seed for the choice among recorded outcomes
+        """
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeHttpHandler)
+        self.capture = capture
+        self.latency_scale = latency_scale
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='FakeHttpServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self._thread.join()
+
+    def local_text(self, text):
+        """
+        Return the given anonymized message, with its urls pointing at this server
+        """
+        return self._re_anonymized_url.sub(self.base_url + r'/\1', text)
+
+    def outcome(self, url):
+        with self._lock:
+            return self.capture.outcome(url, self._random)
+
+
+class ReplayUrlFetcher(UrlFetcher):
+    """
+    A :class:`UrlFetcher` for replaying a capture against a :class:`FakeHttpServer`.
+
+    Every replayed url points at the same local server, with the anonymized host as the first segment
+    of its path. This fetcher tracks latencies by that anonymized host, so each recorded host still gets
+    timeouts of its own, rather than every host sharing those of the local server.
+    """
+
+    _re_anonymized_host = re.compile('/(h[0-9a-f]+\.invalid)/')
+
+    @staticmethod
+    def _host(url):
+        match = ReplayUrlFetcher._re_anonymized_host.match(urlparse.urlsplit(url).path)
+        return match.group(1) if match else UrlFetcher._host(url)
+
+
+class LoadGenerator:
+    """
+    Instances of this class replay the messages of a capture against a parser, with the recorded timing
+    """
+
+    def __init__(self, capture, parser, server, speedup=1.0):
+        """
+        :param capture: The :class:`TrafficCapture` to replay
+        :param parser: The parser to replay the messages against, e.g. an :class:`AsyncParser`
+            fetching with a :class:`ReplayUrlFetcher`
+        :param server: The started :class:`FakeHttpServer` that the urls should point to
+        :param speedup: Replay this many times faster than the messages were recorded
+        """
+        self._capture = capture
+        self._parser = parser
+        self._server = server
+        self._speedup = speedup
+
+    def run(self):
+        """
+        Replay all the messages
+
+        :return: The number of seconds taken
+        """
+        start = time.time()
+        for (i, (t, text)) in enumerate(self._capture.messages):
+            delay = start + t / self._speedup - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            self._parser.parse(Message('replay%d' % i, 'replay', 'replay', self._server.local_text(text)))
+        return time.time() - start
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description='Replay a traffic capture against an AsyncParser')
+    arg_parser.add_argument('capture', help='path of the capture file')
+    arg_parser.add_argument('--speedup', type=float, default=1.0, help='replay this many times faster')
+    arg_parser.add_argument('--latency-scale', type=float, default=1.0, help='multiply recorded latencies by this')
+    arg_parser.add_argument('--workers', type=int, default=5, help='number of parser workers')
+    args = arg_parser.parse_args()
+
+    capture = TrafficCapture.load(args.capture)
+    server = FakeHttpServer(capture, args.latency_scale)
+    server.start()
+    parser = AsyncParser(number_workers=args.workers, url_fetcher=ReplayUrlFetcher())
+    parser.start()
+
+    duration = LoadGenerator(capture, parser, server, args.speedup).run()
+    start = time.time()
+    parser.stop(drain_timeout=60)
+    drain = time.time() - start
+    server.stop()
+
+    print '{} messages replayed in {:f} seconds, {:f} seconds to finish fetching; {} results'.format(
+        len(capture.messages), duration, drain, parser.out_q.qsize())
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,18 @@ __email__ = 'phillip.piper@gmail.com'
 __version__ = '0.1.0'
 
 __all__ = [
+    'ColumnarReader',
+    'ColumnarWriter',
+    'EmoticonVocabulary',
     'HipChatParser',
+    'HostLatencyTracker',
     'NullUrlFetcher',
     'UrlFetcher',
+    'UserDirectory',
 ]
 
 # Make some symbols publically visible outside the module
 
-from hipchatparser import HipChatParser, UrlFetcher, NullUrlFetcher
+from hipchatparser import (EmoticonVocabulary, HipChatParser, HostLatencyTracker, UrlFetcher, NullUrlFetcher,
+                           UserDirectory)
+from columnar import ColumnarReader, ColumnarWriter
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+
+"""
+Bulk export of parse results to a columnar file, for analytics.
+
+Exporting writes the mentions, emoticons and links of each message straight into typed column arrays,
+without going through JSON. The columns are written in row groups of a fixed number of messages,
+so memory use doesn't grow with the size of the archive being exported.
+
+File layout::
+
+    MAGIC
+    row group 0: the chunk of every column of every table, one after another
+    row group 1: ...
+    footer: JSON describing where each chunk is
+    footer length: 8 bytes, little endian
+    MAGIC
+
+There are three tables. Every table has a "message" column holding the (zero based) number of the message
+that each row came from.
+
+- mentions: message, name
+- emoticons: message, name
+- links: message, url, title, status
+
+Integer columns are arrays of 32-bit ints. String columns are UTF-8 bytes, plus an array of the offsets
+of each string within those bytes. A status of -1 means the url fetcher didn't report statuses.
+"""
+
+import array
+import itertools
+import json
+import mmap
+import struct
+import sys
+from hipchatparser import HipChatParser
+
+MAGIC = 'HCPCOL1\n'
+
+# Typecode of the arrays used for integer columns and string offsets
+_INT = 'i'
+
+TABLES = [
+    ('mentions', [('message', 'int'), ('name', 'string')]),
+    ('emoticons', [('message', 'int'), ('name', 'string')]),
+    ('links', [('message', 'int'), ('url', 'string'), ('title', 'string'), ('status', 'int')]),
+]
+
+
+class ColumnarWriter:
+    """
+    Instances of this class write parse results to a columnar file, one row group at a time.
+    """
+
+    def __init__(self, path, row_group_size=10000):
+        """
+        Create a writer for the file at the given path
+
+        :param path: The path of the file. It will be overwritten
+        :param row_group_size: The number of messages in each row group
+        """
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._row_group_size = row_group_size
+        self._row_groups = []
+        self._message_count = 0
+        self._start_row_group()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, details):
+        """
+        Add the details of the next message
+
+        :param details: A dictionary of details, as returned by :meth:`HipChatParser.parse_to_dict`
+            (with link_status=True to record statuses)
+        """
+        n = self._message_count
+        for x in details.get(HipChatParser.DETAIL_MENTIONS, ()):
+            self._append('mentions', n, x)
+        for x in details.get(HipChatParser.DETAIL_EMOTICONS, ()):
+            self._append('emoticons', n, x)
+        for x in details.get(HipChatParser.DETAIL_LINKS, ()):
+            status = x.get(HipChatParser.DETAIL_STATUS)
+            self._append('links', n, x[HipChatParser.DETAIL_URL], x[HipChatParser.DETAIL_TITLE],
+                         status if status is not None else -1)
+
+        self._message_count += 1
+        self._rows_in_group += 1
+        if self._rows_in_group == self._row_group_size:
+            self._flush_row_group()
+
+    def close(self):
+        """
+        Write any remaining rows and the footer, and close the file
+        """
+        if self._file.closed:
+            return
+        if self._rows_in_group:
+            self._flush_row_group()
+        footer = json.dumps({
+            'messages': self._message_count,
+            'byteorder': sys.byteorder,
+            'itemsize': array.array(_INT).itemsize,
+            'row_groups': self._row_groups,
+        })
+        self._file.write(footer)
+        self._file.write(struct.pack('<Q', len(footer)))
+        self._file.write(MAGIC)
+        self._file.close()
+
+    def _start_row_group(self):
+        self._rows_in_group = 0
+        self._columns = dict()
+        for (table, columns) in TABLES:
+            self._columns[table] = [_StringColumn() if kind == 'string' else array.array(_INT)
+                                    for (name, kind) in columns]
+
+    def _append(self, table, *values):
+        for (column, value) in zip(self._columns[table], values):
+            column.append(value)
+
+    def _flush_row_group(self):
+        group = {'first_message': self._message_count - self._rows_in_group, 'messages': self._rows_in_group}
+        for (table, columns) in TABLES:
+            chunks = dict()
+            for ((name, kind), column) in zip(columns, self._columns[table]):
+                if kind == 'string':
+                    chunks[name + '.offsets'] = self._write_chunk(column.offsets.tostring())
+                    chunks[name + '.data'] = self._write_chunk(''.join(column.data))
+                else:
+                    chunks[name] = self._write_chunk(column.tostring())
+            group[table] = {'rows': len(self._columns[table][0]), 'chunks': chunks}
+        self._row_groups.append(group)
+        self._start_row_group()
+
+    def _write_chunk(self, data):
+        """
+        Write the given bytes, and return their (offset, length) within the file
+        """
+        offset = self._file.tell()
+        self._file.write(data)
+        return [offset, len(data)]
+
+
+class _StringColumn:
+    """
+    The strings of one column of the current row group, and their offsets
+    """
+
+    def __init__(self):
+        self.offsets = array.array(_INT, [0])
+        self.data = []
+        self._size = 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def append(self, s):
+        # Byte strings come from pages in any encoding, so anything that isn't UTF-8 is replaced
+        if not isinstance(s, unicode):
+            s = s.decode('utf-8', 'replace')
+        s = s.encode('utf-8')
+        self.data.append(s)
+        self._size += len(s)
+        self.offsets.append(self._size)
+
+
+class ColumnarReader:
+    """
+    Instances of this class read a columnar file written by :class:`ColumnarWriter`.
+
+    The file is memory mapped, and only the chunks of the columns that are asked for are read.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC or self._map[-len(MAGIC):] != MAGIC:
+            self.close()
+            raise ValueError('%s is not a columnar parse results file' % path)
+
+        end = len(self._map) - len(MAGIC)
+        (footer_length,) = struct.unpack('<Q', self._map[end - 8:end])
+        footer = json.loads(self._map[end - 8 - footer_length:end - 8])
+        if footer['itemsize'] != array.array(_INT).itemsize:
+            self.close()
+            raise ValueError('%s was written with %d byte integers' % (path, footer['itemsize']))
+        self._swap = footer['byteorder'] != sys.byteorder
+        self._row_groups = footer['row_groups']
+        self._message_count = footer['messages']
+        self._kinds = dict((table, dict(columns)) for (table, columns) in TABLES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        """
+        The number of messages in the file
+        """
+        return self._message_count
+
+    @property
+    def row_group_count(self):
+        return len(self._row_groups)
+
+    def count(self, table):
+        """
+        Return the number of rows in the given table, without reading any of it
+        """
+        return sum(x[table]['rows'] for x in self._row_groups)
+
+    def column(self, table, name):
+        """
+        Iterate over all the values in one column of a table
+
+        :param table: 'mentions', 'emoticons' or 'links'
+        :param name: The name of the column
+        """
+        kind = self._kinds[table][name]
+        for group in self._row_groups:
+            chunks = group[table]['chunks']
+            if kind == 'string':
+                offsets = self._read_ints(chunks[name + '.offsets'])
+                (data_offset, data_length) = chunks[name + '.data']
+                data = self._map[data_offset:data_offset + data_length]
+                for i in xrange(len(offsets) - 1):
+                    yield data[offsets[i]:offsets[i + 1]].decode('utf-8')
+            else:
+                for x in self._read_ints(chunks[name]):
+                    yield x
+
+    def rows(self, table):
+        """
+        Iterate over the rows of a table, as tuples in the order of its columns
+        """
+        names = [name for (name, kind) in dict(TABLES)[table]]
+        return itertools.izip(*[self.column(table, x) for x in names])
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def _read_ints(self, chunk):
+        (offset, length) = chunk
+        a = array.array(_INT)
+        a.fromstring(self._map[offset:offset + length])
+        if self._swap:
+            a.byteswap()
+        return a
+
+
+def export(messages, path, parser=None, row_group_size=10000):
+    """
+    Parse each of the given messages, and write the results to a columnar file.
+
+    Urls are only fetched once within each row group.
+
+    :param messages: An iterable of strings. It is consumed lazily, so it can be larger than memory
+    :param path: The path of the file to write
+    :param parser: The :class:`HipChatParser` to use. Defaults to a new parser
+    :param row_group_size: The number of messages in each row group
+    :return: The number of messages exported
+    """
+    parser = parser if parser is not None else HipChatParser()
+    count = 0
+    with ColumnarWriter(path, row_group_size) as writer:
+        memo = dict()
+        for message in messages:
+            details = parser.parse_to_dict(message, memo, link_status=True) if message else HipChatParser.NO_DETAILS
+            writer.write(details)
+            count += 1
+            if count % row_group_size == 0:
+                memo = dict()
+    return count
@@ -1,11 +1,33 @@
 # -*- coding: utf-8 -*-
 
+import collections
+import httplib
 import HTMLParser
 import json
+import logging
+import os
+import Queue
 import re
+import socket
+import threading
 import urllib2
+import urlparse
 import time
 
+# Unescaping doesn't use any of the parser's state, so one parser can do it for every thread
+_unescape_html = HTMLParser.HTMLParser().unescape
+
+
+class _EmptyDetails(dict):
+    """
+    An empty dictionary that can't be changed, so that a single instance can safely be shared
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError('The details of a message without any features cannot be changed')
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
 
 class HipChatParser:
     """
@@ -21,13 +43,37 @@ class HipChatParser:
        :ref:`https://www.hipchat.com/emoticons`
 
     3. Links - Any URLs contained in the message, along with the page's title.
+
+    If an :class:`EmoticonVocabulary` is given, only emoticons named in that vocabulary are reported,
+    so that ordinary parenthesised words like "(optional)" or "(2015)" are ignored.
+
+    If a :class:`UserDirectory` is given, the user id of each mention is returned too. The ids are
+    in a list that is parallel to the mentions, with None for any mention that couldn't be resolved.
+
+    Links are fetched by their canonical form (see :meth:`canonicalize_url`), so trivially different
+    forms of the same URL are only fetched once per message (or once per batch, for :meth:`parse_batch`).
+    The URL is still reported exactly as it appeared in the message. :attr:`fetch_count` and
+    :attr:`fetches_avoided` count how many fetches were made, and how many were saved by doing this.
+
+    Each feature can only be present if the message contains its trigger text ('@', '(' or 'http').
+    Looking for those is much cheaper than running the regex's, so only the regex's whose trigger
+    is present are run. Messages without any features all share :attr:`NO_DETAILS` as their result.
+
+    A HipChatParser is thread safe, so a single instance (along with its url fetcher, vocabulary
+    and directory) can be shared by any number of threads. The only exception is a memo dictionary
+    given to :meth:`parse_to_dict`, which should only be used by one thread at a time.
     """
 
     DETAIL_MENTIONS = "mentions"
+    DETAIL_MENTION_IDS = "mention_ids"
     DETAIL_EMOTICONS = "emoticons"
     DETAIL_LINKS = "links"
     DETAIL_URL = "url"
     DETAIL_TITLE = "title"
+    DETAIL_STATUS = "status"
+
+    # The details of every message that has no features. This cannot be changed.
+    NO_DETAILS = _EmptyDetails()
 
     # Pre-compile regex's for slight performance boost
     # Regex to extract URL from: http://stackoverflow.com/questions/6883049/regex-to-find-urls-in-string-in-python
@@ -36,12 +82,24 @@ class HipChatParser:
     _re_title = re.compile('<title>(.*)</title>', re.IGNORECASE)
     _re_url = re.compile('http[s]?://(?:[a-zA-Z]|[0-9]|[$-_@.&+]|[!*\(\),]|(?:%[0-9a-fA-F][0-9a-fA-F]))+')
 
-    def __init__(self, url_fetcher=None, *args, **kwargs):
+    # Characters that the url regex happily includes, but which usually just end the sentence
+    _TRAILING_PUNCTUATION = '.,;:!?\'"'
+    _DEFAULT_PORTS = {'http': ':80', 'https': ':443'}
+
+    def __init__(self, url_fetcher=None, emoticon_vocabulary=None, user_directory=None, *args, **kwargs):
         """
         Create a new HipChatParser
+
+        :param url_fetcher: Used to fetch the pages of any links. Defaults to a :class:`UrlFetcher`
+        :param emoticon_vocabulary: If not None, an :class:`EmoticonVocabulary` of the known emoticons
+        :param user_directory: If not None, a :class:`UserDirectory` used to resolve mentions to user ids
         """
         self._url_fetcher = url_fetcher if url_fetcher is not None else UrlFetcher()
-        self._html_parser = HTMLParser.HTMLParser()
+        self._emoticon_vocabulary = emoticon_vocabulary
+        self._user_directory = user_directory
+        self.fetch_count = 0
+        self.fetches_avoided = 0
+        self._counts_lock = threading.Lock()
 
     def parse(self, message):
         """
@@ -56,28 +114,51 @@ class HipChatParser:
         details = self.parse_to_dict(message)
         return self.dict_to_json(details)
 
-    def parse_to_dict(self, message):
+    def parse_batch(self, messages):
+        """
+        Parse each of the given messages. A URL that appears in more than one message is only fetched once.
+
+        :param messages: A list of strings
+        :return: A list of JSON pretty printed strings
+        """
+        memo = dict()
+        return [self.dict_to_json(self.parse_to_dict(x, memo)) if x else '{}' for x in messages]
+
+    def parse_to_dict(self, message, memo=None, link_status=False):
         """
         Parse the given message for interesting details.
 
         :param message: A non-empty string
-        :return: A dictionary of parsed information
+        :param memo: If not None, a dictionary of the titles of already fetched canonical urls.
+            Pass the same dictionary when parsing several messages to fetch each url only once.
+        :param link_status: If True, each link also has the HTTP status of fetching its page.
+            This is None if the url fetcher doesn't report statuses.
+        :return: A dictionary of parsed information. If the message has no features, this is :attr:`NO_DETAILS`
         """
+        (maybe_mentions, maybe_emoticons, maybe_links) = self._classify(message)
+        if not (maybe_mentions or maybe_emoticons or maybe_links):
+            return HipChatParser.NO_DETAILS
+
         d = dict()
 
-        mentions = self._parse_mentions(message)
-        if len(mentions):
-            d[HipChatParser.DETAIL_MENTIONS] = mentions
+        if maybe_mentions:
+            mentions = self._parse_mentions(message)
+            if len(mentions):
+                d[HipChatParser.DETAIL_MENTIONS] = mentions
+                if self._user_directory is not None:
+                    d[HipChatParser.DETAIL_MENTION_IDS] = self._user_directory.resolve(mentions)
 
-        emoticons = self._parse_emoticons(message)
-        if len(emoticons):
-            d[HipChatParser.DETAIL_EMOTICONS] = emoticons
+        if maybe_emoticons:
+            emoticons = self._parse_emoticons(message)
+            if len(emoticons):
+                d[HipChatParser.DETAIL_EMOTICONS] = emoticons
 
-        links = self._parse_links(message)
-        if len(links):
-            d[HipChatParser.DETAIL_LINKS] = links
+        if maybe_links:
+            links = self._parse_links(message, memo, link_status)
+            if len(links):
+                d[HipChatParser.DETAIL_LINKS] = links
 
-        return d
+        return d if d else HipChatParser.NO_DETAILS
 
     def dict_to_json(self, d):
         """
@@ -86,9 +167,20 @@ class HipChatParser:
         :param d: 
         :return:
         """
+        if not d:
+            return '{}'
         s = json.dumps(d, sort_keys=True, indent=2)
         return s
 
+    def _classify(self, message):
+        """
+        Cheaply decide which features the given message could possibly contain
+
+        :param message:
+        :return: A tuple of booleans: (could have mentions, could have emoticons, could have links)
+        """
+        return '@' in message, '(' in message, 'http' in message
+
     def _parse_mentions(self, message):
         """
         Parse the given message and return a list of users referenced in it
@@ -107,19 +199,31 @@ class HipChatParser:
         :return: A possibly empty list of emoticons
         """
         matches = [x[1:-1] for x in self._re_emoticon.findall(message)]
+        if self._emoticon_vocabulary is not None and len(matches):
+            # Take one snapshot of the names, so a concurrent reload can't change them half way through
+            names = self._emoticon_vocabulary.names
+            matches = [x for x in matches if x in names]
         return matches
 
-    def _parse_links(self, message):
+    def _parse_links(self, message, memo=None, link_status=False):
         """
         Parse the given message and return a list of links mentioned in it.
         Each link is returned as a dictionary containing the url and title
         of the page indicated by the url
 
         :param message:
+        :param memo: See :meth:`parse_to_dict`
+        :param link_status: See :meth:`parse_to_dict`
         :return: A possibly empty list of links
         """
         urls = self._re_url.findall(message)
-        dicts = [{HipChatParser.DETAIL_URL: x, HipChatParser.DETAIL_TITLE: self.fetch_title(x)} for x in urls]
+        fetched = self.fetch_links(urls, memo)
+        dicts = []
+        for (url, (title, status)) in zip(urls, fetched):
+            d = {HipChatParser.DETAIL_URL: url, HipChatParser.DETAIL_TITLE: title}
+            if link_status:
+                d[HipChatParser.DETAIL_STATUS] = status
+            dicts.append(d)
         return dicts
 
     def fetch_title(self, url):
@@ -130,13 +234,397 @@ class HipChatParser:
         :param url: A non-empty string in the format of a URL
         :return: The title of the given url's page
         """
-        html = self._url_fetcher.get(url)
+        return self.fetch_titles([url])[0]
+
+    def fetch_titles(self, urls, memo=None):
+        """
+        Fetch the titles of the pages at the given urls. Urls with the same canonical form are fetched only once.
+        If a URL can't be fetched, or doesn't contain a <title> tag, then the URL itself is its title
+
+        :param urls: A list of non-empty strings in the format of a URL
+        :param memo: See :meth:`parse_to_dict`
+        :return: A list of titles, parallel to the given urls
+        """
+        return [title for (title, status) in self.fetch_links(urls, memo)]
+
+    def fetch_links(self, urls, memo=None):
+        """
+        Fetch the titles of the pages at the given urls, along with the HTTP status of each fetch.
+        This is the same as :meth:`fetch_titles`, except for the statuses.
+
+        :param urls: A list of non-empty strings in the format of a URL
+        :param memo: See :meth:`parse_to_dict`
+        :return: A list of (title, status) pairs, parallel to the given urls. A status is None if
+            the url fetcher doesn't report statuses
+        """
+        if memo is None:
+            memo = dict()
+        links = []
+        fetched = 0
+        for url in urls:
+            key = self.canonicalize_url(url)
+            if key not in memo:
+                fetched += 1
+                memo[key] = self._fetch_link(key)
+            (title, status) = memo[key]
+            links.append((title if title is not None else url, status))
+
+        with self._counts_lock:
+            self.fetch_count += fetched
+            self.fetches_avoided += len(urls) - fetched
+        return links
+
+    def _fetch_link(self, url):
+        """
+        Fetch the title of the page at the given url.
+
+        :return: A tuple of (the title of the given url's page or None if it doesn't have one, the HTTP status)
+        """
+        if hasattr(self._url_fetcher, 'fetch'):
+            (status, html) = self._url_fetcher.fetch(url)
+        else:
+            (status, html) = (None, self._url_fetcher.get(url))
         match = self._re_title.search(html)
         if match:
-            title = self._html_parser.unescape(match.groups(1)[0])
-            return title
-        else:
+            title = match.group(1)
+            # Pages come in any encoding, so anything that isn't UTF-8 is replaced. Then the title can always be JSON
+            if not isinstance(title, unicode):
+                title = title.decode('utf-8', 'replace')
+            return _unescape_html(title), status
+        return None, status
+
+    @staticmethod
+    def canonicalize_url(url):
+        """
+        Return the form of the given url that should be used when fetching or caching it.
+
+        Trailing punctuation and fragments are removed, as are utm_* tracking parameters.
+        The scheme and host are lower cased, and default ports are dropped.
+
+        :param url: A non-empty string in the format of a URL
+        :return: The canonical form of the url
+        """
+        url = url.rstrip(HipChatParser._TRAILING_PUNCTUATION)
+        while url.endswith(')') and url.count(')') > url.count('('):
+            url = url[:-1].rstrip(HipChatParser._TRAILING_PUNCTUATION)
+
+        try:
+            (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+        except ValueError:
+            # The url regex accepts text like "http://[oops", which isn't a valid url. Use it as it is.
             return url
+        scheme = scheme.lower()
+        netloc = netloc.lower()
+        default_port = HipChatParser._DEFAULT_PORTS.get(scheme)
+        if default_port and netloc.endswith(default_port):
+            netloc = netloc[:-len(default_port)]
+        if query:
+            query = '&'.join(x for x in query.split('&') if x and not x.lower().startswith('utm_'))
+        return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+
+class EmoticonVocabulary:
+    """
+    This class holds the catalogue of known emoticon names.
+
+    The names are kept in a frozenset, so checking a candidate emoticon is a single hash lookup.
+    A (re)load builds a completely new frozenset and then swaps it in with one assignment.
+    Parsers on other threads keep using the old names until the swap, so the catalogue
+    can be reloaded without pausing parsing.
+
+    A catalogue file contains one emoticon per line. The name can be given bare ("coffee") or
+    as it would be typed ("(coffee)"). Blank lines and lines starting with '#' are ignored.
+    """
+
+    def __init__(self, names=None, path=None):
+        """
+        Create a new vocabulary from the given names, or from the catalogue file at the given path
+
+        :param names: An iterable of emoticon names
+        :param path: The path to a catalogue file
+        """
+        self._names = frozenset()
+        self._path = path
+        self._mtime = None
+        if names is not None:
+            self.load(names)
+        elif path is not None:
+            self.reload()
+
+    def __contains__(self, name):
+        return name in self._names
+
+    def __len__(self):
+        return len(self._names)
+
+    @property
+    def names(self):
+        """
+        The current frozenset of emoticon names
+        """
+        return self._names
+
+    def load(self, names):
+        """
+        Replace the known emoticons with the given names
+
+        :param names: An iterable of emoticon names (or lines from a catalogue file)
+        """
+        self._names = frozenset(x for x in (self._clean(line) for line in names) if x)
+
+    def load_file(self, path):
+        """
+        Replace the known emoticons with those listed in the given catalogue file.
+        The file will be used for subsequent reloads.
+
+        :param path: The path to a catalogue file
+        """
+        self._path = path
+        self.reload()
+
+    def reload(self):
+        """
+        Re-read the catalogue file
+        """
+        mtime = os.path.getmtime(self._path)
+        with open(self._path) as f:
+            self.load(f)
+        self._mtime = mtime
+
+    def reload_if_changed(self):
+        """
+        Re-read the catalogue file, but only if it has been modified since it was last read.
+
+        :return: True if the catalogue was reloaded
+        """
+        if self._path is None or os.path.getmtime(self._path) == self._mtime:
+            return False
+        self.reload()
+        return True
+
+    @staticmethod
+    def _clean(line):
+        """
+        Return the emoticon name held in the given catalogue line, or an empty string if there isn't one
+        """
+        name = line.strip()
+        if name.startswith('#'):
+            return ''
+        if name.startswith('(') and name.endswith(')'):
+            name = name[1:-1]
+        return name
+
+
+class UserDirectory:
+    """
+    This class is an in-memory index of user handles (the text after the '@' of a mention) to user ids.
+
+    Handles are matched case insensitively. The special handles "all" and "here" are always known,
+    and resolve to the ids "@all" and "@here".
+
+    Handles that aren't in the index can be resolved by a lookup function. All the unknown handles
+    in a message are given to that function in a single call, and its answers are added to the index.
+    Handles the lookup function couldn't resolve are remembered, so they aren't asked about again until
+    they are given to :meth:`update`, or until enough other handles have been found unresolvable since.
+    If the lookup function fails, its handles resolve to None, and are asked about again next time.
+
+    The index is changed in place, under a lock, so a change costs the same however big the directory is.
+    Looking up a single handle in a dictionary is atomic, so resolving mentions doesn't need the lock.
+    """
+
+    SPECIAL_IDS = {
+        'all': '@all',
+        'here': '@here',
+    }
+
+    _logger = logging.getLogger('UserDirectory')
+
+    def __init__(self, users=None, lookup=None, max_unresolvable=10000):
+        """
+        Create a new directory
+
+        :param users: A dictionary (or iterable of pairs) of handles to user ids
+        :param lookup: If not None, a function that is given a list of unknown handles and returns
+            a dictionary of handles to user ids for those that it could resolve
+        :param max_unresolvable: The number of unresolvable handles remembered. The oldest are forgotten first
+        """
+        self._lookup = lookup
+        self._max_unresolvable = max_unresolvable
+        self._lock = threading.Lock()
+        self._index = dict(UserDirectory.SPECIAL_IDS)
+        # The keys are the unresolvable handles, oldest first
+        self._unresolvable = collections.OrderedDict()
+        if users is not None:
+            self.update(users)
+
+    def __contains__(self, handle):
+        return handle.lower() in self._index
+
+    def __len__(self):
+        return len(self._index)
+
+    def update(self, users):
+        """
+        Add, change or remove some entries in the index.
+        Entries that are not mentioned are left as they are.
+
+        :param users: A dictionary (or iterable of pairs) of handles to user ids. A user id of None
+            removes that handle from the index
+        """
+        changes = dict((handle.lower(), user_id) for (handle, user_id) in dict(users).iteritems())
+        with self._lock:
+            for (handle, user_id) in changes.iteritems():
+                self._unresolvable.pop(handle, None)
+                if handle in UserDirectory.SPECIAL_IDS:
+                    continue
+                if user_id is None:
+                    self._index.pop(handle, None)
+                else:
+                    self._index[handle] = user_id
+
+    def resolve(self, handles):
+        """
+        Return the user id of each of the given handles
+
+        :param handles: A list of handles
+        :return: A list of user ids, parallel to the given handles. Unresolvable handles have an id of None
+        """
+        keys = [x.lower() for x in handles]
+        index = self._index
+        unresolvable = self._unresolvable
+        missing = set(x for x in keys if x not in index and x not in unresolvable)
+        if missing and self._lookup is not None:
+            self._lookup_missing(missing)
+        return [index.get(x) for x in keys]
+
+    def _lookup_missing(self, missing):
+        """
+        Ask the lookup function about the given handles in one batch, and add its answers to the index.
+        """
+        try:
+            answers = self._lookup(sorted(missing))
+        except Exception:
+            # Such as the directory service being down. The handles will be asked about again next time.
+            self._logger.exception('Failed to look up %d handles', len(missing))
+            return
+        found = dict((handle.lower(), user_id) for (handle, user_id) in answers.iteritems() if user_id is not None)
+        with self._lock:
+            for (handle, user_id) in found.iteritems():
+                if handle not in UserDirectory.SPECIAL_IDS:
+                    self._index[handle] = user_id
+            for handle in missing.difference(found):
+                self._unresolvable.pop(handle, None)
+                self._unresolvable[handle] = None
+            while len(self._unresolvable) > self._max_unresolvable:
+                self._unresolvable.popitem(last=False)
+
+
+class HostLatencyTracker:
+    """
+    This class keeps track of how long recent fetches from each host took, and derives timeouts from that.
+
+    Each timeout is a high percentile of the host's recent latencies, with some headroom, kept between a global
+    floor and ceiling. Until a host has enough samples, its timeouts are the ceiling. Every consecutive failure
+    to fetch from a host halves its timeouts (down to the floor), so dead hosts soon stop occupying workers.
+
+    Latency is split into connect (until the response headers arrive) and read (fetching the contents).
+
+    Only the most recently fetched hosts are remembered, so that the hosts of every url anyone ever posted
+    don't build up. A host that has been forgotten starts again with the ceiling as its timeouts.
+
+    A single tracker can be shared by many url fetchers and threads.
+    """
+
+    # Consecutive failures stop being counted after this many. Halving the timeouts this often reaches any floor.
+    _MAX_FAILURES = 32
+
+    def __init__(self, floor=1.0, ceiling=10.0, percentile=0.99, headroom=2.0, sample_size=64, min_samples=5,
+                 max_hosts=10000):
+        """
+        :param floor: No timeout is ever shorter than this many seconds
+        :param ceiling: No timeout is ever longer than this many seconds
+        :param percentile: Timeouts are based on this percentile of recent latencies
+        :param headroom: Timeouts are this many times the percentile
+        :param sample_size: The number of recent fetches remembered for each host
+        :param min_samples: Hosts with fewer samples than this use the ceiling as their timeouts
+        :param max_hosts: The number of hosts remembered. The least recently fetched hosts are forgotten first
+        """
+        self.floor = floor
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.headroom = headroom
+        self._sample_size = sample_size
+        self._min_samples = min_samples
+        self._max_hosts = max_hosts
+        # Both are kept in order of when each host was last fetched from, least recent first
+        self._samples = collections.OrderedDict()
+        self._failures = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, host, connect_latency, read_latency):
+        """
+        Record that a fetch from the given host succeeded, taking the given number of seconds
+        """
+        with self._lock:
+            samples = self._samples.pop(host, None)
+            if samples is None:
+                samples = collections.deque(maxlen=self._sample_size)
+            self._samples[host] = samples
+            samples.append((connect_latency, read_latency))
+            self._failures.pop(host, None)
+            self._forget_least_recent(self._samples)
+
+    def record_failure(self, host):
+        """
+        Record that a fetch from the given host failed or timed out
+        """
+        with self._lock:
+            self._failures[host] = min(self._failures.pop(host, 0) + 1, HostLatencyTracker._MAX_FAILURES)
+            self._forget_least_recent(self._failures)
+
+    def timeouts(self, host):
+        """
+        Return the timeouts to use when fetching from the given host
+
+        :return: A tuple of (connect timeout, read timeout) in seconds
+        """
+        with self._lock:
+            samples = list(self._samples.get(host, ()))
+            failures = self._failures.get(host, 0)
+
+        if len(samples) < self._min_samples:
+            timeouts = (self.ceiling, self.ceiling)
+        else:
+            timeouts = tuple(self._percentile(sorted(x), self.percentile) * self.headroom for x in zip(*samples))
+        return tuple(max(self.floor, min(self.ceiling, x / 2 ** failures)) for x in timeouts)
+
+    def hedge_delay(self, host, tail_ratio=3.0):
+        """
+        If the given host has long tail latency, return how long to wait before hedging a fetch from it.
+
+        :param tail_ratio: A host has long tail latency when its 99th percentile is at least this many times its median
+        :return: The host's 95th percentile latency in seconds, or None if the host doesn't have long tail latency
+        """
+        with self._lock:
+            totals = sorted(c + r for (c, r) in self._samples.get(host, ()))
+
+        if len(totals) < self._min_samples:
+            return None
+        if self._percentile(totals, 0.99) < tail_ratio * self._percentile(totals, 0.5):
+            return None
+        return self._percentile(totals, 0.95)
+
+    def _forget_least_recent(self, hosts):
+        """
+        Remove the least recently fetched hosts from the given dictionary, until it's no bigger than max_hosts.
+        The lock must be held.
+        """
+        while len(hosts) > self._max_hosts:
+            hosts.popitem(last=False)
+
+    @staticmethod
+    def _percentile(ordered, fraction):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
 
 
 class UrlFetcher:
@@ -145,14 +633,34 @@ class UrlFetcher:
 
     It allows us to play with different implementations (e.g. urllib2 vs Requests),
     as well as mock out the actual GET during unit tests
+
+    The timeouts of each fetch adapt to how quickly the url's host has answered recently
+    (see :class:`HostLatencyTracker`). If hedging is turned on, then when a fetch from a host with
+    long tail latency is slower than usual, a second identical fetch is started, and whichever
+    finishes first is used.
+
+    A UrlFetcher is thread safe. Sharing one between threads also shares what it learns about each host.
     """
 
     # At most this much of the url will be fetched, when looking for the title
     CHUNK_SIZE = 16 * 1024
 
+    # The contents are read in pieces of this size, so whatever arrived before a timeout can still be used
+    READ_SIZE = 1024
+
     # NOTE: We could use the @lru_cache decorator on this method, after looking
     # to see if there are enough hits to be worth the costs
 
+    def __init__(self, latencies=None, hedge=False):
+        """
+        Create a new UrlFetcher
+
+        :param latencies: The :class:`HostLatencyTracker` used to decide timeouts. Defaults to a new tracker
+        :param hedge: If True, hedge fetches from hosts with long tail latency
+        """
+        self.latencies = latencies if latencies is not None else HostLatencyTracker()
+        self._hedge = hedge
+
     def get(self, url):
         """
         Fetch the first chunk of the contents of the given URL.
@@ -160,13 +668,139 @@ class UrlFetcher:
         If the given url cannot be fetched within a sensible amount of time,
         return an empty string.
         """
+        return self.fetch(url)[1]
+
+    def fetch(self, url):
+        """
+        Fetch the first chunk of the contents of the given URL, along with the HTTP status of the response.
+
+        :return: A tuple of (status, contents). If no response was received in time, the status is 0.
+            If the response was an error, the contents are an empty string.
+        """
+        host = self._host(url)
+        delay = self.latencies.hedge_delay(host) if self._hedge else None
+        if delay is None:
+            return self._fetch_once(url, host)
+        return self._fetch_hedged(url, host, delay)
+
+    @staticmethod
+    def _host(url):
+        """
+        Return the host of the given url, under which its latencies are tracked
+        """
+        try:
+            return urlparse.urlsplit(url).netloc.lower()
+        except ValueError:
+            # Such as an unbalanced '[' in the host. Use whatever is between the '//' and the next '/'
+            return url.partition('//')[2].partition('/')[0].lower()
+
+    def _fetch_once(self, url, host):
+        """
+        Fetch the given URL, with timeouts suited to its host, and record how long that took
+        """
+        (connect_timeout, read_timeout) = self.latencies.timeouts(host)
+        start = time.time()
         try:
-            response = urllib2.urlopen(url)
-            html = response.read(self.CHUNK_SIZE)
-            return html
-        except urllib2.URLError:
+            response = urllib2.urlopen(url, timeout=connect_timeout)
+            connected = time.time()
+            (html, complete) = self._read(response, connected + read_timeout)
+            if complete:
+                self.latencies.record(host, connected - start, time.time() - connected)
+            else:
+                self.latencies.record_failure(host)
+            return response.getcode(), html
+        except urllib2.HTTPError as e:
+            # The host answered promptly enough, even if it wasn't what we wanted
+            self.latencies.record(host, time.time() - start, 0.0)
+            return e.code, ""
+        except (urllib2.URLError, socket.error, httplib.HTTPException, ValueError):
             # THINK - is it worth logging the exception? Probably not, since the url comes from user input
-            return ""
+            self.latencies.record_failure(host)
+            return 0, ""
+
+    def _fetch_hedged(self, url, host, delay):
+        """
+        Fetch the given URL. If that takes longer than the given delay, start a second fetch of it,
+        and use whichever finishes first. A failure is only used if both fetches fail.
+        """
+        results = Queue.Queue()
+
+        def attempt():
+            results.put(self._fetch_once(url, host))
+
+        self._start_attempt(attempt)
+        try:
+            result = results.get(True, delay)
+            attempts = 1
+        except Queue.Empty:
+            self._start_attempt(attempt)
+            result = results.get()
+            attempts = 2
+
+        if result[0] == 0 and attempts == 2:
+            result = results.get()
+        return result
+
+    @staticmethod
+    def _start_attempt(attempt):
+        t = threading.Thread(target=attempt, name='Hedged fetch')
+        t.daemon = True
+        t.start()
+
+    def _read(self, response, deadline):
+        """
+        Read up to CHUNK_SIZE of the given urllib2 response, giving up once the deadline passes
+
+        :return: A tuple of (what was read, whether the read finished before the deadline)
+        """
+        self._set_read_deadline(response, deadline)
+        chunks = []
+        size = 0
+        while size < self.CHUNK_SIZE:
+            try:
+                data = response.read(min(self.READ_SIZE, self.CHUNK_SIZE - size))
+            except socket.timeout:
+                return ''.join(chunks), False
+            if not data:
+                break
+            chunks.append(data)
+            size += len(data)
+        return ''.join(chunks), True
+
+    @staticmethod
+    def _set_read_deadline(response, deadline):
+        """
+        Make every recv() from the socket underneath the given urllib2 response time out at the deadline
+        """
+        try:
+            stream = response.fp._sock.fp
+            stream._sock = _DeadlineSocket(stream._sock, deadline)
+        except AttributeError:
+            # Not a plain HTTP response, so just keep the connect timeout
+            pass
+
+
+class _DeadlineSocket:
+    """
+    Wraps a socket so that each recv() only waits for whatever time is left before a fixed deadline.
+
+    A socket's own timeout applies to each recv() separately, so a server that sends a byte at a time
+    could otherwise keep a fetch going for as long as it liked.
+    """
+
+    def __init__(self, sock, deadline):
+        self._sock = sock
+        self._deadline = deadline
+
+    def recv(self, size):
+        remaining = self._deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout('read deadline passed')
+        self._sock.settimeout(remaining)
+        return self._sock.recv(size)
+
+    def __getattr__(self, name):
+        return getattr(self._sock, name)
 
 
 class NullUrlFetcher:
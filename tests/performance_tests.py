@@ -11,8 +11,14 @@ Compiled regex - 0.676
 import sys
 sys.path.append('..\\hipchatparser')
 
+import gc
+import json
+import os
+import random
+import tempfile
 import timeit
-from hipchatparser import HipChatParser
+from hipchatparser import EmoticonVocabulary, HipChatParser
+from hipchatparser.columnar import export
 from tests.test_hipchatparser import FakeUrlFetcher
 
 
@@ -51,7 +57,7 @@ class PerformanceStatistician:
 - Minimum: {min:f}
 - Maximum: {max:f}
 - Average: {avg:f}
-- Median: {mean:f}""".format(**d)
+- Median: {median:f}""".format(**d)
 
 
 def test1(strings):
@@ -69,6 +75,104 @@ def test2(strings):
     print stats.report()
 
 
+def test3(strings):
+    """
+    Compare throughput with and without emoticon validation against a realistically sized catalogue
+    """
+    names = ['emoticon%d' % i for i in range(5000)] + ['megusta', 'coffee', 'success', 'sunrise', 'thumbsup', 'rotfl']
+    iterations = 1000
+    for label, vocabulary in [('without validation', None), ('with validation', EmoticonVocabulary(names))]:
+        parser = HipChatParser(url_fetcher=FakeUrlFetcher({}), emoticon_vocabulary=vocabulary)
+        executor = lambda: all(parser.parse(x) is not None for x in strings)
+        duration = timeit.timeit(executor, number=iterations)
+        print '{} messages {}: {:f} seconds'.format(len(strings) * iterations, label, duration)
+
+
+class UnfilteredParser(HipChatParser):
+    """
+    A parser that always runs every regex, to measure what the pre-filter saves
+    """
+
+    def _classify(self, message):
+        return True, True, True
+
+
+def make_corpus(count, seed=42):
+    """
+    Make a corpus whose mix of features is like that of a real deployment:
+    most messages have no features at all, and very few have links
+    """
+    rnd = random.Random(seed)
+    words = 'the a to and is it of that you for on this was with but not are have just what so ok'.split()
+    features = [
+        (0.70, lambda: ''),
+        (0.12, lambda: '@' + rnd.choice(['bob', 'john', 'moe', 'larry', 'curly'])),
+        (0.10, lambda: '(' + rnd.choice(['megusta', 'coffee', 'success', 'thumbsup']) + ')'),
+        (0.05, lambda: '@bob (coffee)'),
+        (0.03, lambda: 'https://www.example.com/page/%d' % rnd.randint(1, 100)),
+    ]
+    corpus = []
+    for i in range(count):
+        text = ' '.join(rnd.choice(words) for x in range(rnd.randint(3, 15)))
+        r = rnd.random()
+        for (probability, feature) in features:
+            if r < probability:
+                text = text + ' ' + feature()
+                break
+            r -= probability
+        corpus.append(text.strip())
+    return corpus
+
+
+def test4():
+    """
+    Compare throughput with and without the pre-filter on a realistic corpus
+    """
+    corpus = make_corpus(10000)
+    iterations = 5
+    for label, parser in [('without pre-filter', UnfilteredParser(url_fetcher=FakeUrlFetcher({}))),
+                          ('with pre-filter', HipChatParser(url_fetcher=FakeUrlFetcher({})))]:
+        executor = lambda: all(parser.parse(x) is not None for x in corpus)
+        duration = timeit.timeit(executor, number=iterations)
+        print '{} realistic messages {}: {:f} seconds'.format(len(corpus) * iterations, label, duration)
+
+
+def test5():
+    """
+    Compare loading parse results via parse() and json.loads with exporting them to a columnar file
+    """
+    corpus = make_corpus(50000)
+    parser = HipChatParser(url_fetcher=FakeUrlFetcher({}))
+    duration = timeit.timeit(lambda: [json.loads(parser.parse(x)) for x in corpus], number=1)
+    print '{} messages via parse() and json.loads: {:f} seconds'.format(len(corpus), duration)
+
+    (fd, path) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        duration = timeit.timeit(lambda: export(corpus, path, parser), number=1)
+        print '{} messages via columnar export: {:f} seconds ({} bytes)'.format(len(corpus), duration,
+                                                                               os.path.getsize(path))
+    finally:
+        os.remove(path)
+
+
+def test6(number_workers=50):
+    """
+    Compare the objects allocated by a parser per worker with one parser shared by all the workers
+    """
+    def allocated(make):
+        gc.collect()
+        before = set(id(x) for x in gc.get_objects())
+        kept = make()
+        gc.collect()
+        new = [x for x in gc.get_objects() if id(x) not in before and x is not kept and x is not before]
+        return len(new), sum(sys.getsizeof(x) for x in new)
+
+    for label, make in [('a parser per worker', lambda: [HipChatParser() for i in range(number_workers)]),
+                        ('one shared parser', lambda: [HipChatParser()] * number_workers)]:
+        print '{} workers with {}: {} objects, {} bytes'.format(number_workers, label, *allocated(make))
+
+
 def main():
     strings = [
         'String with any matching features but that is somewhat long)',
@@ -84,6 +188,10 @@ def main():
     ]
     test1(strings)
     test2(strings)
+    test3(strings)
+    test4()
+    test5()
+    test6()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
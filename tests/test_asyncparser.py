@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import Queue
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from asyncparsing import AsyncParser, Message
+from asyncparsing.asyncparser import BatchingQueue
+from asyncparsing.hipchatparser import EmoticonVocabulary, UserDirectory
+
+
+class SlowUrlFetcher:
+    """
+    A fake url fetcher that counts its fetches, and doesn't return until its gate is open
+    """
+
+    def __init__(self, delay=0.0):
+        self.delay = delay
+        self.gate = threading.Event()
+        self.gate.set()
+        self.requested = []
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            self.requested.append(url)
+        self.gate.wait()
+        time.sleep(self.delay)
+        return '<title>Title of %s</title>' % url
+
+
+def drain_queue(q):
+    items = []
+    while True:
+        try:
+            items.append(q.get_nowait())
+        except Queue.Empty:
+            return items
+
+
+def link_messages(count):
+    return [Message('guid%d' % i, 'c1', 'larry', 'look at http://example.com/%d' % i) for i in range(count)]
+
+
+class BrokenUrlFetcher(SlowUrlFetcher):
+    """
+    A fake url fetcher whose first fetch fails with an unexpected error
+    """
+
+    def get(self, url):
+        html = SlowUrlFetcher.get(self, url)
+        with self._lock:
+            if len(self.requested) == 1:
+                raise RuntimeError('unexpected')
+        return html
+
+
+class Latin1UrlFetcher:
+    """
+    A fake url fetcher whose pages are all encoded in latin-1
+    """
+
+    def get(self, url):
+        return '<title>Caf\xe9</title>'
+
+
+class TestAsyncParser(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._checkpoint_path = os.path.join(self._dir, 'checkpoint')
+
+    def test_Stop_Drain_AllTitlesLookedUp(self):
+        fetcher = SlowUrlFetcher(delay=0.01)
+        p = AsyncParser(number_workers=2, url_fetcher=fetcher)
+        p.start()
+        for msg in link_messages(10):
+            p.parse(msg)
+        p.stop(drain_timeout=5)
+
+        # Each message is sent once without its title, and once with it
+        self.assertEqual(len(drain_queue(p.out_q)), 20)
+        self.assertEqual(len(fetcher.requested), 10)
+        self.assertFalse(os.path.exists(self._checkpoint_path))
+
+    def test_Stop_DrainTimesOut_CheckpointResumedByNextStart(self):
+        fetcher = SlowUrlFetcher()
+        fetcher.gate.clear()
+        p = AsyncParser(number_workers=1, checkpoint_path=self._checkpoint_path, url_fetcher=fetcher)
+        p.start()
+        for msg in link_messages(3):
+            p.parse(msg)
+
+        # The only worker is stuck on the first message until well after the drain deadline
+        threading.Timer(0.5, fetcher.gate.set).start()
+        p.stop(drain_timeout=0.1)
+        self.assertEqual(len(drain_queue(p.out_q)), 3 + 1)
+        self.assertTrue(os.path.exists(self._checkpoint_path))
+
+        p2 = AsyncParser(number_workers=1, checkpoint_path=self._checkpoint_path, url_fetcher=fetcher)
+        p2.start()
+        p2.stop(drain_timeout=5)
+        updates = drain_queue(p2.out_q)
+        self.assertEqual(sorted(x.message_id for x in updates), ['guid1', 'guid2'])
+        self.assertEqual(updates[0].details['links'][0]['title'], 'Title of %s' % updates[0].details['links'][0]['url'])
+        self.assertEqual(sorted(fetcher.requested), ['http://example.com/%d' % i for i in range(3)])
+        self.assertFalse(os.path.exists(self._checkpoint_path))
+
+    def test_Checkpoint_KeptUntilResumedMessagesDealtWith(self):
+        fetcher = SlowUrlFetcher()
+        fetcher.gate.clear()
+        p = AsyncParser(number_workers=1, checkpoint_path=self._checkpoint_path, url_fetcher=fetcher)
+        p.start()
+        for msg in link_messages(3):
+            p.parse(msg)
+        threading.Timer(0.3, fetcher.gate.set).start()
+        p.stop(drain_timeout=0.1)
+
+        # A parser that dies after resuming the checkpoint leaves it for the next one
+        fetcher.gate.clear()
+        p2 = AsyncParser(number_workers=1, checkpoint_path=self._checkpoint_path, url_fetcher=fetcher)
+        p2.start()
+        self.assertTrue(os.path.exists(self._checkpoint_path))
+        fetcher.gate.set()
+
+        p3 = AsyncParser(number_workers=1, checkpoint_path=self._checkpoint_path, url_fetcher=SlowUrlFetcher())
+        p3.start()
+        p3.stop(drain_timeout=5)
+        self.assertEqual(sorted(x.message_id for x in drain_queue(p3.out_q)), ['guid1', 'guid2'])
+        self.assertFalse(os.path.exists(self._checkpoint_path))
+        p2.stop(drain_timeout=5)
+
+    def test_EmoticonVocabulary_UnknownIgnored(self):
+        vocabulary = EmoticonVocabulary(['coffee'])
+        p = AsyncParser(number_workers=1, url_fetcher=SlowUrlFetcher(), emoticon_vocabulary=vocabulary)
+        p.start()
+        p.parse(Message('guid1', 'c1', 'larry', '(coffee) (optional)'))
+        p.stop()
+        self.assertEqual(p.out_q.get_nowait().details, {'emoticons': ['coffee']})
+
+    def test_UserDirectory_MentionsResolved(self):
+        directory = UserDirectory({'moe': 'u2'})
+        p = AsyncParser(number_workers=1, url_fetcher=SlowUrlFetcher(), user_directory=directory)
+        p.start()
+        p.parse(Message('guid1', 'c1', 'larry', 'morning @moe, @curly'))
+        p.stop()
+        self.assertEqual(p.out_q.get_nowait().details, {'mentions': ['moe', 'curly'], 'mention_ids': ['u2', None]})
+
+    def test_IdleWorkers_UseNoCpu_AndStopTogether(self):
+        p = AsyncParser(number_workers=50, url_fetcher=SlowUrlFetcher())
+        p.start()
+        time.sleep(0.1)
+
+        cpu_before = sum(os.times()[:2])
+        time.sleep(1)
+        idle_cpu = sum(os.times()[:2]) - cpu_before
+
+        start = time.time()
+        p.stop()
+        shutdown = time.time() - start
+
+        self.assertLess(idle_cpu, 0.02)
+        self.assertLess(shutdown, 0.2)
+
+    def test_Batching_FlushedWhenFull(self):
+        p = AsyncParser(number_workers=1, url_fetcher=SlowUrlFetcher(), batch_size=3, batch_interval=10)
+        p.start()
+        for i in range(7):
+            p.parse(Message('guid%d' % i, 'c1', 'larry', 'hello @moe'))
+        batches = [p.out_q.get(True, 1) for i in range(2)]
+        self.assertEqual([[x.message_id for x in b] for b in batches], [['guid0', 'guid1', 'guid2'],
+                                                                        ['guid3', 'guid4', 'guid5']])
+        p.stop()
+        self.assertEqual([x.message_id for x in p.out_q.get_nowait()], ['guid6'])
+
+    def test_Batching_FlushedAfterInterval(self):
+        p = AsyncParser(number_workers=1, url_fetcher=SlowUrlFetcher(), batch_size=100, batch_interval=0.05)
+        p.start()
+        start = time.time()
+        p.parse(Message('guid1', 'c1', 'larry', 'hello'))
+        p.parse(Message('guid2', 'c1', 'larry', 'hello'))
+        batch = p.out_q.get(True, 1)
+        elapsed = time.time() - start
+        p.stop()
+        self.assertEqual([x.message_id for x in batch], ['guid1', 'guid2'])
+        self.assertGreaterEqual(elapsed, 0.04)
+        self.assertLess(elapsed, 0.5)
+
+    def test_Batching_TitleUpdateMergedIntoPendingBatch(self):
+        p = AsyncParser(number_workers=1, url_fetcher=SlowUrlFetcher(), batch_size=100, batch_interval=0.5)
+        p.start()
+        for msg in link_messages(2):
+            p.parse(msg)
+        p.stop(drain_timeout=5)
+
+        batches = drain_queue(p.out_q)
+        self.assertEqual(len(batches), 1)
+        self.assertEqual([x.message_id for x in batches[0]], ['guid0', 'guid1'])
+        for x in batches[0]:
+            self.assertEqual(x.details['links'][0]['title'], 'Title of http://example.com/%s' % x.message_id[-1])
+
+    def test_Batching_PutAfterClose_SentAlone(self):
+        out_q = Queue.Queue()
+        q = BatchingQueue(out_q, 100, 10)
+        q.put('a')
+        q.close()
+        q.put('b')
+        self.assertEqual(drain_queue(out_q), [['a'], ['b']])
+
+    def test_BadMessage_WorkersSurviveAndRestartCleanly(self):
+        fetcher = BrokenUrlFetcher()
+        p = AsyncParser(number_workers=2, url_fetcher=fetcher)
+        p.start()
+        for msg in link_messages(3):
+            p.parse(msg)
+        p.stop(drain_timeout=5)
+        self.assertEqual(len(fetcher.requested), 3)
+        self.assertEqual(p._worker_q.qsize(), 0)
+
+        p.start()
+        self.assertTrue(all(t.is_alive() for t in p._threads))
+        p.parse(link_messages(4)[3])
+        p.stop(drain_timeout=5)
+        self.assertEqual(len(fetcher.requested), 4)
+
+    def test_Latin1Title_UpdateSent(self):
+        p = AsyncParser(number_workers=1, url_fetcher=Latin1UrlFetcher())
+        p.start()
+        p.parse(link_messages(1)[0])
+        p.stop(drain_timeout=5)
+        results = drain_queue(p.out_q)
+        self.assertEqual(len(results), 2)
+        self.assertEqual(results[1].details['links'][0]['title'], u'Caf\ufffd')
+        self.assertIn('Caf\\ufffd', results[1].details_as_json)
+
+    def test_Start_StaleStopSentinelsDiscarded(self):
+        from asyncparsing.asyncparser import ParserWorkerThread
+        p = AsyncParser(number_workers=2, checkpoint_path=self._checkpoint_path, url_fetcher=SlowUrlFetcher())
+        p._worker_q.put(ParserWorkerThread.STOP)
+        p.parse(link_messages(1)[0])
+        p.start()
+        p.stop(drain_timeout=5)
+        self.assertEqual(len(drain_queue(p.out_q)), 2)
+        self.assertEqual(p._worker_q.qsize(), 0)
+        self.assertFalse(os.path.exists(self._checkpoint_path))
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+if __name__ == '__main__':
+    unittest.main()
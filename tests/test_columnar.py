@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from hipchatparser import ColumnarReader, HipChatParser
+from hipchatparser.columnar import export
+from tests.test_hipchatparser import CountingUrlFetcher, FakeUrlFetcher
+
+
+class StatusUrlFetcher(FakeUrlFetcher):
+    """
+    A fake url fetcher that also reports a status: 200 for known urls, 404 for the rest
+    """
+
+    def fetch(self, url):
+        if url in self._dict:
+            return 200, self._dict[url]
+        return 404, ''
+
+
+class TestColumnar(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._path = os.path.join(self._dir, 'results.col')
+
+    def test_Export_RoundTrip(self):
+        fetcher = StatusUrlFetcher({'http://example.com/a': u'<title>Caf\xe9</title>'})
+        messages = [
+            '@bob @john (success)',
+            '',
+            'plain text',
+            'see http://example.com/a and http://example.com/b',
+            '@moe (coffee)',
+        ]
+        self.assertEqual(export(messages, self._path, HipChatParser(url_fetcher=fetcher), row_group_size=2), 5)
+
+        with ColumnarReader(self._path) as r:
+            self.assertEqual(len(r), 5)
+            self.assertEqual(r.row_group_count, 3)
+            self.assertEqual(r.count('mentions'), 3)
+            self.assertEqual(list(r.rows('mentions')), [(0, 'bob'), (0, 'john'), (4, 'moe')])
+            self.assertEqual(list(r.column('emoticons', 'name')), ['success', 'coffee'])
+            self.assertEqual(list(r.column('emoticons', 'message')), [0, 4])
+            self.assertEqual(list(r.rows('links')), [
+                (3, 'http://example.com/a', u'Caf\xe9', 200),
+                (3, 'http://example.com/b', 'http://example.com/b', 404),
+            ])
+
+    def test_Export_NonUtf8Title_Replaced(self):
+        fetcher = StatusUrlFetcher({'http://example.com/a': '<title>Caf\xe9</title>'})
+        export(['http://example.com/a'], self._path, HipChatParser(url_fetcher=fetcher))
+        with ColumnarReader(self._path) as r:
+            self.assertEqual(list(r.column('links', 'title')), [u'Caf\ufffd'])
+
+    def test_Export_FetcherWithoutStatus_StatusMinusOne(self):
+        export(['http://example.com/a'], self._path, HipChatParser(url_fetcher=FakeUrlFetcher()))
+        with ColumnarReader(self._path) as r:
+            self.assertEqual(list(r.column('links', 'status')), [-1])
+
+    def test_Export_UrlsFetchedOncePerRowGroup(self):
+        fetcher = CountingUrlFetcher()
+        export(['http://example.com/a'] * 5, self._path, HipChatParser(url_fetcher=fetcher), row_group_size=2)
+        self.assertEqual(len(fetcher.requested), 3)
+
+    def test_Reader_NotColumnarFile_ValueError(self):
+        with open(self._path, 'wb') as f:
+            f.write('{"mentions": []}' * 10)
+        self.assertRaises(ValueError, ColumnarReader, self._path)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+if __name__ == '__main__':
+    unittest.main()
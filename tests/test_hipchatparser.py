@@ -1,8 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import BaseHTTPServer
+import os
+import tempfile
+import threading
+import time
 import unittest
-from hipchatparser import HipChatParser
+from hipchatparser import EmoticonVocabulary, HipChatParser, HostLatencyTracker, NullUrlFetcher, UrlFetcher, \
+    UserDirectory
 
 class FakeUrlFetcher:
     """
@@ -25,6 +31,80 @@ class FakeUrlFetcher:
         return self._dict.get(url, url)
 
 
+class CountingUrlFetcher(FakeUrlFetcher):
+    """
+    A fake url fetcher that remembers which urls it was asked to fetch
+    """
+
+    def __init__(self, d=None):
+        FakeUrlFetcher.__init__(self, d)
+        self.requested = []
+
+    def get(self, url):
+        self.requested.append(url)
+        return FakeUrlFetcher.get(self, url)
+
+
+class SlowHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers every request after a delay given by the server
+    """
+
+    def do_GET(self):
+        time.sleep(self.server.delay)
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write('<title>Slow</title>')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class DrippingHttpHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers promptly, then sends the page one byte at a time, with a delay given by the server between each
+    """
+
+    def do_GET(self):
+        page = '<title>Drip</title>' + ' ' * 20
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(page)))
+        self.end_headers()
+        for c in page:
+            self.wfile.write(c)
+            self.wfile.flush()
+            time.sleep(self.server.delay)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class QuietHttpServer(BaseHTTPServer.HTTPServer):
+    """
+    A server that doesn't complain when a client gives up on it
+    """
+
+    def handle_error(self, request, client_address):
+        pass
+
+
+class ScriptedUrlFetcher(UrlFetcher):
+    """
+    A url fetcher whose successive fetches take the given times and return the given results
+    """
+
+    def __init__(self, script, **kwargs):
+        UrlFetcher.__init__(self, **kwargs)
+        self._script = list(script)
+        self._lock = threading.Lock()
+
+    def _fetch_once(self, url, host):
+        with self._lock:
+            (delay, result) = self._script.pop(0)
+        time.sleep(delay)
+        return result
+
+
 class TestHipchatparser(unittest.TestCase):
     def setUp(self):
         pass
@@ -132,6 +212,298 @@ class TestHipchatparser(unittest.TestCase):
              '}')
         self.assertMultiLineEqual(p.parse(s), t)
 
+    def test_Parse_Emoticons_Vocabulary_UnknownIgnored(self):
+        p = HipChatParser(emoticon_vocabulary=EmoticonVocabulary(['megusta', 'coffee']))
+        s = 'Good morning! (megusta) (optional) (2015) (coffee)'
+        self.assertEqual(p.parse_to_dict(s), {'emoticons': ['megusta', 'coffee']})
+
+    def test_Parse_Emoticons_EmptyVocabulary_EmptyJsonString(self):
+        p = HipChatParser(emoticon_vocabulary=EmoticonVocabulary())
+        s = 'Good morning! (megusta) (coffee)'
+        self.assertEqual(p.parse(s), '{}')
+
+    def test_EmoticonVocabulary_LoadFile_IgnoresCommentsAndBrackets(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, '# HipChat emoticons\n(megusta)\n\ncoffee\n')
+            os.close(fd)
+            v = EmoticonVocabulary(path=path)
+            self.assertEqual(v.names, frozenset(['megusta', 'coffee']))
+        finally:
+            os.remove(path)
+
+    def test_EmoticonVocabulary_ReloadIfChanged(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            os.write(fd, 'megusta\n')
+            os.close(fd)
+            v = EmoticonVocabulary(path=path)
+            p = HipChatParser(emoticon_vocabulary=v)
+            self.assertFalse(v.reload_if_changed())
+
+            with open(path, 'w') as f:
+                f.write('coffee\n')
+            os.utime(path, (0, 0))
+
+            self.assertTrue(v.reload_if_changed())
+            self.assertEqual(p.parse_to_dict('(megusta) (coffee)'), {'emoticons': ['coffee']})
+        finally:
+            os.remove(path)
+
+    def test_Parse_Mentions_Directory_IdsParallelToMentions(self):
+        p = HipChatParser(user_directory=UserDirectory({'bob': 'u1', 'John': 'u2'}))
+        s = '@bob @john @nobody @all'
+        t = ('{\n'
+             '  "mention_ids": [\n'
+             '    "u1", \n'
+             '    "u2", \n'
+             '    null, \n'
+             '    "@all"\n'
+             '  ], \n'
+             '  "mentions": [\n'
+             '    "bob", \n'
+             '    "john", \n'
+             '    "nobody", \n'
+             '    "all"\n'
+             '  ]\n'
+             '}')
+        self.assertMultiLineEqual(p.parse(s), t)
+
+    def test_UserDirectory_Resolve_MissesLookedUpOnceInBatch(self):
+        calls = []
+
+        def lookup(handles):
+            calls.append(handles)
+            return {'bob': 'u1'}
+
+        d = UserDirectory(lookup=lookup)
+        self.assertEqual(d.resolve(['bob', 'moe', 'here', 'bob']), ['u1', None, '@here', 'u1'])
+        self.assertEqual(d.resolve(['bob', 'moe']), ['u1', None])
+        self.assertEqual(calls, [['bob', 'moe']])
+
+    def test_UserDirectory_LookupFails_NoneThenRetried(self):
+        calls = []
+
+        def lookup(handles):
+            calls.append(handles)
+            if len(calls) == 1:
+                raise IOError('directory service is down')
+            return {'bob': 'u1'}
+
+        p = HipChatParser(user_directory=UserDirectory(lookup=lookup))
+        self.assertEqual(p.parse_to_dict('@bob')['mention_ids'], [None])
+        self.assertEqual(p.parse_to_dict('@bob')['mention_ids'], ['u1'])
+        self.assertEqual(calls, [['bob'], ['bob']])
+
+    def test_UserDirectory_OldestUnresolvableForgotten(self):
+        calls = []
+
+        def lookup(handles):
+            calls.extend(handles)
+            return {}
+
+        d = UserDirectory(lookup=lookup, max_unresolvable=2)
+        for handle in ['a', 'b', 'a', 'c', 'a']:
+            d.resolve([handle])
+        self.assertEqual(calls, ['a', 'b', 'c', 'a'])
+
+    def test_UserDirectory_Update_Incremental(self):
+        d = UserDirectory({'bob': 'u1', 'moe': 'u2'}, lookup=lambda handles: {})
+        d.resolve(['larry'])
+        d.update({'moe': None, 'larry': 'u3', 'all': 'x'})
+        self.assertEqual(d.resolve(['bob', 'moe', 'larry', 'all']), ['u1', None, 'u3', '@all'])
+
+    def test_CanonicalizeUrl(self):
+        c = HipChatParser.canonicalize_url
+        self.assertEqual(c('HTTP://WWW.Example.com:80/Path?a=1&utm_source=x&UTM_medium=y#top'),
+                         'http://www.example.com/Path?a=1')
+        self.assertEqual(c('https://example.com:443/a.'), 'https://example.com/a')
+        self.assertEqual(c('https://example.com/a),'), 'https://example.com/a')
+        self.assertEqual(c('https://en.wikipedia.org/wiki/Foo_(bar)'), 'https://en.wikipedia.org/wiki/Foo_(bar)')
+        self.assertEqual(c('https://example.com/a?utm_source=x'), 'https://example.com/a')
+
+    def test_Parse_Links_NonUtf8Title_Replaced(self):
+        p = HipChatParser(url_fetcher=FakeUrlFetcher({'http://example.com/a': '<title>Caf\xe9 &amp; Bar</title>'}))
+        d = p.parse_to_dict('see http://example.com/a')
+        self.assertEqual(d['links'][0]['title'], u'Caf\ufffd & Bar')
+        self.assertIn('Caf\\ufffd & Bar', p.dict_to_json(d))
+
+    def test_Parse_Links_InvalidUrl_KeptAsItIs(self):
+        self.assertEqual(HipChatParser.canonicalize_url('http://[oops.'), 'http://[oops')
+        p = HipChatParser(url_fetcher=NullUrlFetcher())
+        self.assertEqual(p.parse_to_dict('see http://[oops'),
+                         {'links': [{'url': 'http://[oops', 'title': 'http://[oops'}]})
+        self.assertEqual(UrlFetcher(HostLatencyTracker(floor=0.1, ceiling=0.1)).fetch('http://[oops/a'), (0, ''))
+
+    def test_Parse_Links_DuplicatesFetchedOnce_OriginalUrlsKept(self):
+        fetcher = CountingUrlFetcher({"http://example.com/a": "<title>A</title>"})
+        p = HipChatParser(url_fetcher=fetcher)
+        s = 'http://example.com/a, http://Example.COM:80/a and http://example.com/a?utm_source=chat.'
+        d = p.parse_to_dict(s)
+        self.assertEqual(d['links'], [
+            {'url': 'http://example.com/a,', 'title': 'A'},
+            {'url': 'http://Example.COM:80/a', 'title': 'A'},
+            {'url': 'http://example.com/a?utm_source=chat.', 'title': 'A'},
+        ])
+        self.assertEqual(fetcher.requested, ['http://example.com/a'])
+        self.assertEqual((p.fetch_count, p.fetches_avoided), (1, 2))
+
+    def test_ParseBatch_DuplicatesAcrossMessagesFetchedOnce(self):
+        fetcher = CountingUrlFetcher()
+        p = HipChatParser(url_fetcher=fetcher)
+        results = p.parse_batch(['see http://example.com/a', '', 'again http://example.com/a#more'])
+        self.assertEqual(len(results), 3)
+        self.assertEqual(results[1], '{}')
+        self.assertEqual(fetcher.requested, ['http://example.com/a'])
+        self.assertEqual((p.fetch_count, p.fetches_avoided), (1, 1))
+
+    def test_ParseToDict_NoFeatures_SharedImmutableResult(self):
+        p = HipChatParser()
+        d = p.parse_to_dict('this string contains no interesting markup')
+        self.assertIs(d, HipChatParser.NO_DETAILS)
+        self.assertIs(p.parse_to_dict('a lonely @ and (unclosed'), HipChatParser.NO_DETAILS)
+        self.assertRaises(TypeError, d.__setitem__, 'mentions', [])
+        self.assertEqual(d, {})
+
+    def test_HostLatencyTracker_Timeouts(self):
+        t = HostLatencyTracker(floor=0.5, ceiling=10.0, percentile=0.99, headroom=2.0, min_samples=5)
+        self.assertEqual(t.timeouts('a.com'), (10.0, 10.0))
+
+        for i in range(5):
+            t.record('fast.com', 0.01, 0.01)
+            t.record('slow.com', 2.0, 1.0)
+            t.record('glacial.com', 30.0, 30.0)
+        self.assertEqual(t.timeouts('fast.com'), (0.5, 0.5))
+        self.assertEqual(t.timeouts('slow.com'), (4.0, 2.0))
+        self.assertEqual(t.timeouts('glacial.com'), (10.0, 10.0))
+
+        t.record_failure('slow.com')
+        t.record_failure('slow.com')
+        self.assertEqual(t.timeouts('slow.com'), (1.0, 0.5))
+        t.record('slow.com', 2.0, 1.0)
+        self.assertEqual(t.timeouts('slow.com'), (4.0, 2.0))
+
+        for i in range(4):
+            t.record_failure('dead.com')
+        self.assertEqual(t.timeouts('dead.com'), (0.625, 0.625))
+
+    def test_HostLatencyTracker_ManyFailures_StayAtFloor(self):
+        t = HostLatencyTracker(floor=0.5, ceiling=10.0)
+        for i in range(2000):
+            t.record_failure('dead.com')
+        self.assertEqual(t.timeouts('dead.com'), (0.5, 0.5))
+
+    def test_HostLatencyTracker_LeastRecentHostsForgotten(self):
+        t = HostLatencyTracker(floor=0.5, ceiling=10.0, min_samples=1, max_hosts=2)
+        t.record('a.com', 2.0, 1.0)
+        t.record('b.com', 2.0, 1.0)
+        t.record('a.com', 2.0, 1.0)
+        t.record('c.com', 2.0, 1.0)
+        self.assertEqual(t.timeouts('a.com'), (4.0, 2.0))
+        self.assertEqual(t.timeouts('b.com'), (10.0, 10.0))
+        self.assertEqual(t.timeouts('c.com'), (4.0, 2.0))
+
+        for host in ['a.com', 'b.com', 'c.com']:
+            t.record_failure(host)
+        self.assertEqual(t.timeouts('a.com'), (4.0, 2.0))
+        self.assertEqual(t.timeouts('c.com'), (2.0, 1.0))
+
+    def test_HostLatencyTracker_HedgeDelay_OnlyForLongTail(self):
+        t = HostLatencyTracker()
+        for i in range(95):
+            t.record('steady.com', 0.1, 0.1)
+            t.record('tail.com', 0.1, 0.1)
+        for i in range(5):
+            t.record('steady.com', 0.15, 0.1)
+            t.record('tail.com', 5.0, 0.1)
+        self.assertIsNone(t.hedge_delay('steady.com'))
+        self.assertAlmostEqual(t.hedge_delay('tail.com'), 5.1)
+
+    def test_UrlFetcher_Fetch_SlowHostTimesOut(self):
+        server = QuietHttpServer(('127.0.0.1', 0), SlowHttpHandler)
+        server.delay = 1.0
+        threading.Thread(target=server.handle_request).start()
+        try:
+            f = UrlFetcher(HostLatencyTracker(floor=0.1, ceiling=0.2))
+            start = time.time()
+            self.assertEqual(f.fetch('http://127.0.0.1:%d/' % server.server_address[1]), (0, ''))
+            self.assertLess(time.time() - start, 0.8)
+        finally:
+            time.sleep(server.delay)
+            server.server_close()
+
+    def test_UrlFetcher_Fetch_DrippingHostStopsAtReadDeadline(self):
+        server = QuietHttpServer(('127.0.0.1', 0), DrippingHttpHandler)
+        server.delay = 0.05
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            latencies = HostLatencyTracker(floor=0.3, ceiling=0.3)
+            f = UrlFetcher(latencies)
+            start = time.time()
+            (status, html) = f.fetch('http://127.0.0.1:%d/' % server.server_address[1])
+            self.assertLess(time.time() - start, 1.0)
+            self.assertEqual(status, 200)
+            self.assertLess(len(html), 39)
+            self.assertEqual(latencies.timeouts('127.0.0.1:%d' % server.server_address[1]), (0.3, 0.3))
+        finally:
+            thread.join()
+            server.server_close()
+
+    def test_UrlFetcher_Hedged_SecondFetchWinsAfterDelay(self):
+        latencies = HostLatencyTracker()
+        for i in range(20):
+            latencies.record('tail.com', 0.01, 0.0)
+        latencies.record('tail.com', 1.0, 0.0)
+        f = ScriptedUrlFetcher([(1.0, (200, 'first')), (0.0, (200, 'second'))], latencies=latencies, hedge=True)
+        start = time.time()
+        self.assertEqual(f.fetch('http://tail.com/'), (200, 'second'))
+        self.assertLess(time.time() - start, 0.5)
+
+    def test_UrlFetcher_Hedged_FailureOnlyUsedIfBothFail(self):
+        latencies = HostLatencyTracker()
+        for i in range(20):
+            latencies.record('tail.com', 0.01, 0.0)
+        latencies.record('tail.com', 1.0, 0.0)
+        f = ScriptedUrlFetcher([(0.2, (200, 'first')), (0.0, (0, ''))], latencies=latencies, hedge=True)
+        self.assertEqual(f.fetch('http://tail.com/'), (200, 'first'))
+
+    def test_SharedParser_ManyThreads_SameResultsAndCounts(self):
+        fetcher = FakeUrlFetcher({'http://example.com/a': '<title>A &amp; B</title>'})
+        directory = UserDirectory({'bob': 'u1'}, lookup=lambda handles: dict((x, 'id-' + x) for x in handles))
+        p = HipChatParser(url_fetcher=fetcher, emoticon_vocabulary=EmoticonVocabulary(['coffee']),
+                          user_directory=directory)
+        messages = [
+            '@bob @moe (coffee) (optional) http://example.com/a http://example.com/a#again',
+            'plain text',
+            '@user%d see http://example.com/%d',
+        ]
+        thread_count = 32
+        iterations = 200
+        failures = []
+
+        def work(n):
+            for i in range(iterations):
+                for m in messages:
+                    m = m.replace('%d', str(i % 10))
+                    if p.parse(m) != expected[m]:
+                        failures.append((n, m))
+
+        reference = HipChatParser(url_fetcher=fetcher, emoticon_vocabulary=EmoticonVocabulary(['coffee']),
+                                  user_directory=UserDirectory({'bob': 'u1'}, lookup=directory._lookup))
+        expected = dict((m.replace('%d', str(i)), reference.parse(m.replace('%d', str(i))))
+                        for m in messages for i in range(10))
+
+        threads = [threading.Thread(target=work, args=(n,)) for n in range(thread_count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(failures, [])
+        self.assertEqual(p.fetch_count, thread_count * iterations * 2)
+        self.assertEqual(p.fetches_avoided, thread_count * iterations)
+
     def tearDown(self):
         pass
 
@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import unittest
+from asyncparsing import AsyncParser, Message
+from asyncparsing.hipchatparser import EmoticonVocabulary, HostLatencyTracker
+from asyncparsing.traffic import Anonymizer, FakeHttpServer, LoadGenerator, ReplayUrlFetcher, TrafficCapture, \
+    TrafficRecorder
+from tests.test_asyncparser import SlowUrlFetcher, drain_queue
+
+
+class TestTraffic(unittest.TestCase):
+    def setUp(self):
+        self._dir = tempfile.mkdtemp()
+        self._capture_path = os.path.join(self._dir, 'capture.jsonl')
+
+    def test_Anonymizer_KeepsFeatures(self):
+        a = Anonymizer('salt', EmoticonVocabulary(['coffee']))
+        s = a.text('@Larry see (coffee) http://www.example.com/secret, @larry')
+        self.assertNotIn('arry', s)
+        self.assertNotIn('example', s)
+        self.assertNotIn('secret', s)
+        self.assertIn('(coffee)', s)
+        words = s.split()
+        self.assertEqual(words[0], words[-1])
+        self.assertEqual(words[1], 'xxx')
+        self.assertEqual(words[3], a.url('http://www.example.com/secret'))
+
+    def test_Anonymizer_NonAsciiAndUnknownEmoticons_Hidden(self):
+        a = Anonymizer('salt', EmoticonVocabulary(['coffee']))
+        s = a.text(u'J\xfcrgen M\xfcller said \u6771\u4eac secret (password1) (coffee) @bob \u2603!')
+        self.assertEqual(s[:30], u'xxxxxx xxxxxx xxxx xx xxxxxx (')
+        self.assertNotIn('password1', s)
+        self.assertNotIn('bob', s)
+        self.assertIn('(coffee)', s)
+        self.assertTrue(s.endswith(u' x!'))
+        self.assertEqual(set(s.replace('(coffee)', '')) - set(u'x @()!0123456789abcdefu'), set())
+
+        # Byte strings holding UTF-8 are anonymized too
+        self.assertEqual(a.text(u'J\xfcrgen'.encode('utf-8')), 'x' * 7)
+
+    def test_Anonymizer_InvalidUrl_Anonymized(self):
+        a = Anonymizer('salt')
+        s = a.text('see http://[secret')
+        self.assertNotIn('secret', s)
+        self.assertEqual(s, 'xxx ' + a.url('http://[secret'))
+
+    def test_RecordThenReplay_ReproducesFetches(self):
+        messages = [
+            Message('guid1', 'c1', 'larry', 'morning @moe, morning @curly'),
+            Message('guid2', 'c1', 'larry', 'look (thumbsup) https://www.example.com/1'),
+            Message('guid3', 'c1', 'larry', 'and https://www.example.com/2'),
+        ]
+        recorder = TrafficRecorder(self._capture_path)
+        p = AsyncParser(number_workers=2, url_fetcher=SlowUrlFetcher(delay=0.05), recorder=recorder)
+        p.start()
+        for msg in messages:
+            p.parse(msg)
+        p.stop(drain_timeout=5)
+        recorder.close()
+
+        with open(self._capture_path) as f:
+            recorded = f.read()
+        for secret in ['moe', 'curly', 'example.com']:
+            self.assertNotIn(secret, recorded)
+
+        capture = TrafficCapture.load(self._capture_path)
+        self.assertEqual(len(capture.messages), 3)
+        self.assertEqual(len(capture.fetches), 2)
+        for x in capture.fetches:
+            self.assertGreaterEqual(x['latency'], 0.05)
+            self.assertEqual(x['status'], 200)
+            self.assertEqual(x['title_size'], len('Title of https://www.example.com/1'))
+
+        server = FakeHttpServer(capture)
+        server.start()
+        try:
+            p2 = AsyncParser(number_workers=2, url_fetcher=ReplayUrlFetcher())
+            p2.start()
+            LoadGenerator(capture, p2, server, speedup=100).run()
+            p2.stop(drain_timeout=5)
+        finally:
+            server.stop()
+
+        results = drain_queue(p2.out_q)
+        titles = [x.details['links'][0]['title'] for x in results[3:]]
+        self.assertEqual(titles, ['x' * len('Title of https://www.example.com/1')] * 2)
+
+    def test_Replay_HostsKeepTheirOwnLatencies(self):
+        messages = []
+        fetches = []
+        for (host, latency) in [('h00000001.invalid', 0.0), ('h00000002.invalid', 0.3)]:
+            for i in range(6):
+                url = 'http://%s/%012d' % (host, i)
+                messages.append((0.0, 'see ' + url))
+                fetches.append({'url': url, 'latency': latency, 'status': 200, 'bytes': 100, 'title_size': 5})
+        capture = TrafficCapture(messages, fetches)
+
+        fetcher = ReplayUrlFetcher(HostLatencyTracker(floor=0.01))
+        server = FakeHttpServer(capture)
+        server.start()
+        try:
+            p = AsyncParser(number_workers=4, url_fetcher=fetcher)
+            p.start()
+            LoadGenerator(capture, p, server).run()
+            p.stop(drain_timeout=10)
+        finally:
+            server.stop()
+
+        self.assertEqual(len(drain_queue(p.out_q)), 2 * len(messages))
+        (fast_connect, fast_read) = fetcher.latencies.timeouts('h00000001.invalid')
+        (slow_connect, slow_read) = fetcher.latencies.timeouts('h00000002.invalid')
+        self.assertLess(fast_connect, 0.3)
+        self.assertGreaterEqual(slow_connect, 0.6)
+        self.assertLess(slow_connect, fetcher.latencies.ceiling)
+
+    def tearDown(self):
+        shutil.rmtree(self._dir)
+
+if __name__ == '__main__':
+    unittest.main()